@@ -2,19 +2,26 @@
 # -*- coding:utf-8 -*-
 import asyncio
 import base64
+import bisect
+import hashlib
 import logging
+import mmap
 import os
-import subprocess
-import threading
+import re
+import shutil
 import time
 import uuid
-from collections import deque
+from collections import deque, OrderedDict
 
-from quart import current_app, Response, stream_with_context
+from quart import current_app, jsonify, request, Response, stream_with_context
 
+from backend import config
 from backend.api import blueprint
+from backend.auth import admin_auth_required
+from backend.models import Session, ChannelSource, Playlist, PlaylistStreams
 import aiohttp
-from urllib.parse import urlparse
+from sqlalchemy import and_, select
+from urllib.parse import urljoin, urlparse
 
 # Test:
 #       > mkfifo /tmp/ffmpegpipe
@@ -36,219 +43,1366 @@ proxy_logger = logging.getLogger("proxy")
 ffmpeg_logger = logging.getLogger("ffmpeg")
 buffer_logger = logging.getLogger("buffer")
 
+# Upper limit (in bytes) of the stream data held in memory for each active FFmpegStream.
+# This buffer is shared by all viewers of the stream.
+hls_proxy_stream_buffer_bytes = int(os.environ.get('HLS_PROXY_STREAM_BUFFER_BYTES', 16 * 1024 * 1024))
+
+# How far (in bytes) a single viewer may fall behind the live edge of a stream before the lag policy is applied.
+# Policies:
+#   - 'skip_to_keyframe': jump the viewer forward to the latest keyframe in the buffer (default)
+#   - 'drop_oldest':      discard the oldest unsent data for the viewer until it is back within the limit
+#   - 'disconnect':       close the viewer's connection
+hls_proxy_client_max_lag_bytes = int(os.environ.get('HLS_PROXY_CLIENT_MAX_LAG_BYTES', 8 * 1024 * 1024))
+hls_proxy_client_lag_policy = os.environ.get('HLS_PROXY_CLIENT_LAG_POLICY', 'skip_to_keyframe')
+
+# Upper limit (in bytes) of the HLS segments and keys held in the proxy cache.
+hls_proxy_cache_max_bytes = int(os.environ.get('HLS_PROXY_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+# Optional on-disk second tier for the segment cache. Set a byte limit to enable it.
+# The path may be pointed at a tmpfs mount. Segments are kept in a tic-segment-cache directory under it.
+hls_proxy_disk_cache_max_bytes = int(os.environ.get('HLS_PROXY_DISK_CACHE_MAX_BYTES', 0))
+hls_proxy_disk_cache_path = os.environ.get('HLS_PROXY_DISK_CACHE_PATH', os.path.join(config.config_path, 'cache', 'hls'))
+
+# Upstream connection pool settings. Timeouts are in seconds.
+hls_proxy_upstream_connections = int(os.environ.get('HLS_PROXY_UPSTREAM_CONNECTIONS', 100))
+hls_proxy_upstream_connections_per_host = int(os.environ.get('HLS_PROXY_UPSTREAM_CONNECTIONS_PER_HOST', 20))
+hls_proxy_dns_cache_ttl = int(os.environ.get('HLS_PROXY_DNS_CACHE_TTL', 300))
+hls_proxy_keepalive_timeout = float(os.environ.get('HLS_PROXY_KEEPALIVE_TIMEOUT', 30))
+hls_proxy_connect_timeout = float(os.environ.get('HLS_PROXY_CONNECT_TIMEOUT', 10))
+hls_proxy_read_timeout = float(os.environ.get('HLS_PROXY_READ_TIMEOUT', 30))
+
+# Seconds to keep an FFmpegStream (and its buffer) running after the last viewer disconnects.
+# A viewer that reconnects or zaps back within this time joins the running stream instead of waiting for a new one.
+hls_proxy_stream_linger = float(os.environ.get('HLS_PROXY_STREAM_LINGER', 15))
+
+# Seconds without new input before an FFmpegStream is considered stalled and stopped.
+# Progress is read from FFmpeg's -progress output. Inputs such as HLS arrive in bursts (a whole segment at a time),
+# so the timeout only starts once the media received so far would have finished playing in real time. Streams
+# that report no progress fall back to the time since their last output, so keep this above the longest segment
+# duration expected.
+# The start timeout allows for connecting to and probing the input before anything has been received.
+hls_proxy_stream_stall_timeout = float(os.environ.get('HLS_PROXY_STREAM_STALL_TIMEOUT', 20))
+hls_proxy_stream_start_timeout = float(os.environ.get('HLS_PROXY_STREAM_START_TIMEOUT', 30))
+
+# Channel relay failover settings. Timeouts are in seconds.
+# A source is abandoned if it produces no output within the start timeout, stops producing output for longer than
+# the stall timeout, or its bitrate (in bits/s, measured over 5 second windows) falls below the minimum.
+# The relay ends after every source has failed this many times in a row.
+hls_proxy_failover_start_timeout = float(os.environ.get('HLS_PROXY_FAILOVER_START_TIMEOUT', 10))
+hls_proxy_failover_stall_timeout = float(os.environ.get('HLS_PROXY_FAILOVER_STALL_TIMEOUT', 1.5))
+hls_proxy_failover_min_bitrate = int(os.environ.get('HLS_PROXY_FAILOVER_MIN_BITRATE', 32000))
+hls_proxy_failover_max_rounds = int(os.environ.get('HLS_PROXY_FAILOVER_MAX_ROUNDS', 3))
+
+# Server side HLS repackaging settings.
+# Streams are segmented into a rolling window of segments under this path, which should be a tmpfs mount.
+# Each stream gets its own directory there. Only those directories are removed at startup.
+# The segment duration is in seconds. Repackaging stops once no client has requested it for the idle timeout.
+hls_proxy_repackage_path = os.environ.get(
+    'HLS_PROXY_REPACKAGE_PATH',
+    '/dev/shm/tic-hls-live' if os.path.isdir('/dev/shm') else os.path.join(config.config_path, 'cache', 'hls-live')
+)
+hls_proxy_repackage_segment_duration = int(os.environ.get('HLS_PROXY_REPACKAGE_SEGMENT_DURATION', 2))
+hls_proxy_repackage_segment_count = int(os.environ.get('HLS_PROXY_REPACKAGE_SEGMENT_COUNT', 6))
+hls_proxy_repackage_idle_timeout = float(os.environ.get('HLS_PROXY_REPACKAGE_IDLE_TIMEOUT', 30))
+
+# MPEG-TS constants used to find where new viewers can start decoding in a shared stream buffer
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+TS_VIDEO_STREAM_TYPES = {0x01, 0x02, 0x10, 0x1b, 0x24, 0x42, 0xea}
+
+# Names of the files and directories written by the disk cache and the repackager (SHA-1 hex digests of URLs).
+# Only these are ever removed from the configured paths, which may be shared with other files.
+CACHE_FILE_NAME_RE = re.compile(r'^[0-9a-f]{40}(\.tmp)?$')
+
+# A dictionary of upstream downloads currently in progress, keyed by URL
+inflight_downloads = {}
+
+# Manifest polling settings (in seconds).
+# Pollers stop after no client has requested their manifest for this long (or 3 target durations if longer).
+hls_proxy_manifest_idle_timeout = float(os.environ.get('HLS_PROXY_MANIFEST_IDLE_TIMEOUT', 30))
+# Refresh interval for manifests without a target duration (master playlists) or that have ended (VOD)
+hls_proxy_manifest_default_ttl = float(os.environ.get('HLS_PROXY_MANIFEST_DEFAULT_TTL', 30))
+
+# Default segment prefetch settings for playlists that do not configure their own.
+# The number of segments from the live edge to prefetch, and how many of them may be fetched at once per upstream.
+hls_proxy_prefetch_segments = int(os.environ.get('HLS_PROXY_PREFETCH_SEGMENTS', 3))
+hls_proxy_prefetch_concurrency = int(os.environ.get('HLS_PROXY_PREFETCH_CONCURRENCY', 2))
+
+# Number of upstream URLs remembered by the proxy URL registry (least recently used are dropped first).
+# Rewritten manifests reference child URLs by a short registry ID, so this should comfortably exceed the number of
+# segments, keys and variant playlists referenced by all manifests being watched at once.
+hls_proxy_url_registry_size = int(os.environ.get('HLS_PROXY_URL_REGISTRY_SIZE', 50000))
+
+# Seconds a new upstream session waits for a free playlist connection slot before the request is rejected with a 503
+hls_proxy_slot_wait_timeout = float(os.environ.get('HLS_PROXY_SLOT_WAIT_TIMEOUT', 10))
+
+# Cached per-playlist proxy settings, keyed by playlist ID
+playlist_proxy_settings = {}
+
+# Semaphores limiting concurrent prefetches, keyed by playlist ID (or upstream host)
+prefetch_semaphores = {}
+
+# A dictionary of shared upstream manifest pollers, keyed by URL
+manifest_pollers = {}
+
 # A dictionary to keep track of active streams
 active_streams = {}
 
+# Active server side HLS repackagers, keyed by upstream URL
+hls_repackagers = {}
+
+
+class LatencyHistogram:
+    """A fixed bucket histogram of durations in seconds."""
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """Return (upper bound, count of observations <= bound) pairs, ending with +Inf."""
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def snapshot(self):
+        return {
+            'count':   self.count,
+            'sum':     round(self.sum, 6),
+            'buckets': {('+Inf' if bound == float('inf') else str(bound)): count
+                        for bound, count in self.cumulative_counts()},
+        }
+
+
+class ProxyMetrics:
+    """
+    Counters and histograms describing proxy activity.
+
+    Everything is updated from the event loop, so plain integers are enough and recording a value is a dict update.
+    Counters are keyed by (name, label) so that they can be exported as labelled metrics.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, label='', value=1):
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, label, value):
+        histogram = self.histograms.get((name, label))
+        if histogram is None:
+            histogram = self.histograms[(name, label)] = LatencyHistogram()
+        histogram.observe(value)
+
+
+metrics = ProxyMetrics()
+
+
+async def count_bytes_served(chunks, kind, url_entry=None):
+    """Pass through an async iterator of response chunks, counting the bytes sent to the client."""
+    async for chunk in chunks:
+        metrics.inc('bytes_served', kind, len(chunk))
+        if url_entry is not None:
+            url_entry.bytes_served += len(chunk)
+        yield chunk
+
+
+class FFmpegProgress:
+    """
+    State parsed from FFmpeg's machine readable -progress output.
+
+    FFmpeg writes a block of key=value lines every half second while it is processing packets, ending with a
+    progress=continue (or progress=end) line. The output time only advances while packets are arriving from the input.
+    With stream copy, the reported bitrate is the bitrate of the input.
+
+    The playout time is the wall clock time at which the media received so far would finish playing in real time.
+    Each advance of the output time extends it, so a burst of input (eg. a whole HLS segment) covers the wait for the
+    next one.
+    """
+
+    # Limit on how far ahead of the wall clock the playout time can get, for inputs read faster than real time
+    max_playout_ahead = 120
+
+    def __init__(self):
+        self.values = {}
+        self.bitrate = None  # bits/s
+        self.speed = None
+        self.frame = None
+        self.drop_frames = 0
+        self.dup_frames = 0
+        self.total_size = 0
+        self.out_time_us = None
+        self.updates = 0
+        self.updated_at = None  # When the last progress block was received
+        self.advanced_at = None  # When the output time last moved forward
+        self.playout_until = None
+
+    @staticmethod
+    def _parse_number(value, suffix=''):
+        if suffix and value.endswith(suffix):
+            value = value[:-len(suffix)]
+        try:
+            return float(value)
+        except ValueError:
+            # FFmpeg reports 'N/A' until it has something to measure
+            return None
+
+    def parse_line(self, line):
+        """
+        Parse one line of FFmpeg's stderr. Returns False if the line is not part of the progress output.
+        """
+        key, separator, value = line.partition('=')
+        if not separator or not key or ' ' in key:
+            return False
+        key = key.strip()
+        value = value.strip()
+        if key != 'progress':
+            self.values[key] = value
+            return True
+        self.update(self.values)
+        self.values = {}
+        return True
+
+    def update(self, values):
+        now = time.time()
+        bitrate = self._parse_number(values.get('bitrate', 'N/A'), 'kbits/s')
+        if bitrate is not None:
+            self.bitrate = int(bitrate * 1000)
+        self.speed = self._parse_number(values.get('speed', 'N/A'), 'x')
+        frame = self._parse_number(values.get('frame', 'N/A'))
+        if frame is not None:
+            self.frame = int(frame)
+        for key in ('drop_frames', 'dup_frames', 'total_size'):
+            number = self._parse_number(values.get(key, 'N/A'))
+            if number is not None:
+                setattr(self, key, int(number))
+        out_time_us = self._parse_number(values.get('out_time_us', values.get('out_time_ms', 'N/A')))
+        if out_time_us is not None and (self.out_time_us is None or out_time_us > self.out_time_us):
+            if self.out_time_us is not None:
+                advanced = (out_time_us - self.out_time_us) / 1000000
+                self.playout_until = min(max(self.playout_until or now, now) + advanced, now + self.max_playout_ahead)
+            self.out_time_us = int(out_time_us)
+            self.advanced_at = now
+        self.updates += 1
+        self.updated_at = now
+
+    def stats(self):
+        now = time.time()
+        buffered = None if self.playout_until is None else round(max(self.playout_until - now, 0), 3)
+        return {
+            "bitrate":                self.bitrate,
+            "speed":                  self.speed,
+            "frame":                  self.frame,
+            "drop_frames":            self.drop_frames,
+            "dup_frames":             self.dup_frames,
+            "total_size":             self.total_size,
+            "out_time":               None if self.out_time_us is None else round(self.out_time_us / 1000000, 3),
+            "seconds_since_progress": None if self.updated_at is None else round(now - self.updated_at, 3),
+            "seconds_since_advance":  None if self.advanced_at is None else round(now - self.advanced_at, 3),
+            "seconds_buffered":       buffered,
+        }
+
 
 class FFmpegStream:
     def __init__(self, decoded_url):
         self.decoded_url = decoded_url
-        self.buffers = {}
+        self.buffer = StreamRingBuffer(max_bytes=hls_proxy_stream_buffer_bytes)
+        self.readers = {}
         self.process = None
         self.running = True
-        self.thread = threading.Thread(target=self.run_ffmpeg)
+        self.task = None
+        self.linger_handle = None
         self.connection_count = 0
-        self.lock = threading.Lock()
         self.last_activity = time.time()  # Track last activity time
-        self.thread.start()
-
-    def run_ffmpeg(self):
-        command = [
+        self.slot = None  # (playlist ID, session URL) of the connection slot held by this stream
+        self.rejected = False
+        self.slot_ready = asyncio.Event()
+        self.partial_packet = b''
+        self.started_at = time.time()
+        self.progress = FFmpegProgress()
+        self.process_started_at = None
+        self.last_packet_at = None  # When output was last read from FFmpeg
+        self.stalls = 0
+
+    def start(self):
+        """Start the FFmpeg relay as a task on the running event loop."""
+        self.task = asyncio.create_task(self.run_ffmpeg())
+
+    def ffmpeg_command(self, url):
+        return [
             'ffmpeg', '-hide_banner', '-loglevel', 'info', '-err_detect', 'ignore_err',
+            '-progress', 'pipe:2', '-nostats',
             '-probesize', '20M', '-analyzeduration', '0', '-fpsprobesize', '0',
-            '-i', self.decoded_url,
+            '-i', url,
             '-c', 'copy',
             '-f', 'mpegts', 'pipe:1'
         ]
-        ffmpeg_logger.info("Executing FFmpeg with command: %s", command)
-        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-        # Start a thread to log stderr
-        stderr_thread = threading.Thread(target=self.log_stderr)
-        stderr_thread.daemon = True  # Make this a daemon thread so it exits when main thread exits
-        stderr_thread.start()
-
-        chunk_size = 65536  # Read 64 KB at a time
-        while self.running:
-            try:
-                # Use select to avoid blocking indefinitely
-                import select
-                ready, _, _ = select.select([self.process.stdout], [], [], 1.0)
-                if not ready:
-                    # No data available, check if we should terminate due to inactivity
-                    if time.time() - self.last_activity > 300:  # 5 minutes of inactivity
-                        ffmpeg_logger.info("No activity for 5 minutes, terminating FFmpeg stream")
-                        self.stop()
+    async def start_process(self, url):
+        command = self.ffmpeg_command(url)
+        ffmpeg_logger.info("Executing FFmpeg with command: %s", command)
+        self.process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        self.partial_packet = b''
+        self.progress = FFmpegProgress()
+        self.process_started_at = time.time()
+        self.last_packet_at = None
+        # Log stderr alongside reading stdout
+        return asyncio.create_task(self.log_stderr())
+
+    def append_output(self, chunk):
+        """
+        Append FFmpeg output to the shared buffer. Returns the number of bytes appended.
+        Only ever append whole TS packets so that the buffer can be scanned and joined at packet boundaries.
+        """
+        if self.partial_packet:
+            chunk = self.partial_packet + chunk
+        aligned_length = len(chunk) - (len(chunk) % TS_PACKET_SIZE)
+        self.partial_packet = chunk[aligned_length:]
+        if not aligned_length:
+            return 0
+        # Append the chunk once to the shared buffer. This wakes any readers waiting for data.
+        self.buffer.append(chunk[:aligned_length] if self.partial_packet else chunk)
+        return aligned_length
+
+    async def run_ffmpeg(self):
+        stderr_task = None
+        try:
+            # Wait for a free connection slot on the stream's playlist before opening the upstream connection
+            acquired, playlist_id, session_url = await acquire_connection_slot(self.decoded_url, self)
+            if not acquired:
+                self.rejected = True
+                return
+            self.slot = (playlist_id, session_url)
+            self.slot_ready.set()
+            stderr_task = await self.start_process(self.decoded_url)
+
+            chunk_size = 65536  # Read 64 KB at a time
+            while self.running:
+                try:
+                    chunk = await asyncio.wait_for(self.process.stdout.read(chunk_size), timeout=1)
+                except asyncio.TimeoutError:
+                    stall_reason = self.stall_reason()
+                    if stall_reason:
+                        ffmpeg_logger.warning("FFmpeg stream '%s' has stalled (%s), terminating it",
+                                              self.decoded_url, stall_reason)
+                        self.stalls += 1
+                        metrics.inc('stream_stalls', type(self).__name__)
                         break
                     continue
-                
-                chunk = self.process.stdout.read(chunk_size)
                 if not chunk:
                     ffmpeg_logger.warning("FFmpeg has finished streaming.")
                     break
-                
+
                 # Update last activity time
                 self.last_activity = time.time()
-                
-                # Append the chunk to all buffers
-                with self.lock:  # Use lock when accessing buffers
-                    for buffer in self.buffers.values():
-                        buffer.append(chunk)
-            except Exception as e:
-                ffmpeg_logger.error("Error reading stdout: %s", e)
-                break
-
-        self.cleanup()
+                self.last_packet_at = self.last_activity
+                self.append_output(chunk)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            ffmpeg_logger.error("Error reading stdout: %s", e)
+        finally:
+            if stderr_task:
+                stderr_task.cancel()
+            await self.cleanup()
 
-    def cleanup(self):
-        """Clean up resources properly"""
-        self.running = False
-        if self.process:
+    async def terminate_process(self):
+        if self.process and self.process.returncode is None:
             try:
                 # Try to terminate the process gracefully first
                 self.process.terminate()
                 # Wait a bit for it to terminate
                 try:
-                    self.process.wait(timeout=5)
-                except subprocess.TimeoutExpired:
+                    await asyncio.wait_for(self.process.wait(), timeout=5)
+                except asyncio.TimeoutError:
                     # If it doesn't terminate, kill it
                     self.process.kill()
-                    self.process.wait()
+                    await self.process.wait()
+            except ProcessLookupError:
+                pass
             except Exception as e:
                 ffmpeg_logger.error("Error terminating FFmpeg process: %s", e)
-            
-            # Close file descriptors
-            if self.process.stdout:
-                self.process.stdout.close()
-            if self.process.stderr:
-                self.process.stderr.close()
-            
+
+    async def cleanup(self):
+        """Clean up resources properly"""
+        self.running = False
+        await self.terminate_process()
+
         ffmpeg_logger.info("FFmpeg process cleaned up.")
-        
-        # Clear buffers
-        with self.lock:
-            self.buffers.clear()
+
+        # Release the connection slot and wake any connections still waiting for one
+        if self.slot is not None:
+            await connection_slots.release(*self.slot, self)
+            self.slot = None
+        self.slot_ready.set()
+        # Clear readers, release the buffered stream data and wake any readers still waiting on it
+        self.cancel_linger()
+        self.readers.clear()
+        self.buffer.close()
+        if active_streams.get(self.decoded_url) is self:
+            del active_streams[self.decoded_url]
 
     def stop(self):
         """Stop the FFmpeg process and clean up resources"""
         if self.running:
             self.running = False
-            self.cleanup()
-
-    def log_stderr(self):
-        """Log stderr output from the FFmpeg process."""
-        while self.running and self.process and self.process.stderr:
+            if self.task and not self.task.done():
+                # Cancelling the relay task terminates the process from its cleanup
+                self.task.cancel()
+
+    def last_input_at(self):
+        """
+        Return when the FFmpeg process last received input, or None if it has not yet.
+        Input counts as arriving while FFmpeg writes output or its reported output time moves forward.
+        """
+        return max(self.last_packet_at or 0, self.progress.advanced_at or 0) or None
+
+    def stall_reason(self):
+        """Return why the FFmpeg process looks stalled, or None if it is still receiving input."""
+        if self.process_started_at is None:
+            return None
+        now = time.time()
+        last_input = self.last_input_at()
+        if last_input is None:
+            if now - self.process_started_at > hls_proxy_stream_start_timeout:
+                return f"no input within {hls_proxy_stream_start_timeout:g} seconds of starting"
+            return None
+        # Input that arrived in a burst keeps the stream going until it would have finished playing
+        idle_since = max(last_input, self.progress.playout_until or 0)
+        if now - idle_since > hls_proxy_stream_stall_timeout:
+            return f"no input for {now - last_input:.1f} seconds"
+        return None
+
+    async def log_stderr(self):
+        """Parse the progress reports from the FFmpeg process and log the rest of its stderr output."""
+        while self.process and self.process.stderr:
             try:
-                line = self.process.stderr.readline()
+                line = await self.process.stderr.readline()
                 if not line:
                     break
-                ffmpeg_logger.debug("FFmpeg: %s", line.decode('utf-8', errors='replace').strip())
+                self.handle_stderr_line(line.decode('utf-8', errors='replace').strip())
+            except asyncio.CancelledError:
+                break
             except Exception as e:
                 ffmpeg_logger.error("Error reading stderr: %s", e)
                 break
 
-    def add_buffer(self, buffer_id):
-        """Add a new per-connection TimeBuffer with proper locking."""
-        with self.lock:
-            if buffer_id not in self.buffers:
-                self.buffers[buffer_id] = TimeBuffer()
-                self.connection_count += 1
-                ffmpeg_logger.info(f"Added buffer {buffer_id}, connection count: {self.connection_count}")
-            return self.buffers[buffer_id]
-
-    def remove_buffer(self, buffer_id):
-        """Remove a buffer with proper locking"""
-        with self.lock:
-            if buffer_id in self.buffers:
-                del self.buffers[buffer_id]
-                self.connection_count -= 1
-                ffmpeg_logger.info(f"Removed buffer {buffer_id}, connection count: {self.connection_count}")
-                # If no more connections, stop the stream
-                if self.connection_count <= 0:
+    def handle_stderr_line(self, line):
+        if not self.progress.parse_line(line):
+            ffmpeg_logger.debug("FFmpeg: %s", line)
+
+    def add_reader(self, reader_id):
+        """Add a new per-connection reader cursor into the shared stream buffer."""
+        if reader_id not in self.readers:
+            self.cancel_linger()
+            self.readers[reader_id] = self.buffer.create_reader(reader_id)
+            self.connection_count += 1
+            ffmpeg_logger.info(f"Added reader {reader_id}, connection count: {self.connection_count}")
+        return self.readers[reader_id]
+
+    def remove_reader(self, reader_id):
+        """Remove a reader and stop the stream once the last one has gone and the linger period has passed"""
+        if reader_id in self.readers:
+            del self.readers[reader_id]
+            self.connection_count -= 1
+            ffmpeg_logger.info(f"Removed reader {reader_id}, connection count: {self.connection_count}")
+            # If no more connections, stop the stream
+            if self.connection_count <= 0:
+                if hls_proxy_stream_linger > 0 and self.running:
+                    ffmpeg_logger.info("No more connections, keeping FFmpeg stream warm for %s seconds",
+                                       hls_proxy_stream_linger)
+                    loop = asyncio.get_running_loop()
+                    self.linger_handle = loop.call_later(hls_proxy_stream_linger, self.linger_expired)
+                else:
                     ffmpeg_logger.info("No more connections, stopping FFmpeg stream")
-                    # Schedule the stop to happen outside of the lock
-                    threading.Thread(target=self.stop).start()
+                    self.stop()
+
+    def stats(self):
+        last_packet_age = None if self.last_packet_at is None else round(time.time() - self.last_packet_at, 3)
+        return {
+            "url":                       self.decoded_url,
+            "type":                      type(self).__name__,
+            "running":                   self.running,
+            "connection_count":          self.connection_count,
+            "uptime":                    int(time.time() - self.started_at),
+            "bytes_read":                self.buffer.head_offset,
+            "buffered_bytes":            self.buffer.size,
+            "slow_reader_drops":         self.buffer.slow_reader_drops,
+            "seconds_since_last_packet": last_packet_age,
+            "stalls":                    self.stalls,
+            "ffmpeg":                    self.progress.stats(),
+            "readers":                   {
+                reader_id: {
+                    "lag_bytes":     self.buffer.reader_lag(reader),
+                    "bytes_sent":    reader.bytes_sent,
+                    "dropped_bytes": reader.dropped_bytes,
+                    "lag_events":    reader.lag_events,
+                    "connected_for": int(time.time() - reader.connected_at),
+                }
+                for reader_id, reader in self.readers.items()
+            },
+        }
+
+    def cancel_linger(self):
+        if self.linger_handle is not None:
+            self.linger_handle.cancel()
+            self.linger_handle = None
+
+    def linger_expired(self):
+        self.linger_handle = None
+        if self.connection_count <= 0:
+            ffmpeg_logger.info("No new connections during linger period, stopping FFmpeg stream")
+            self.stop()
+
+
+class ContinuityCounterFixer:
+    """
+    Rewrites the continuity counters of TS packets so that each PID's sequence carries on across a source switch.
+
+    Every new FFmpeg process restarts its counters, which players and TVHeadend would otherwise report as
+    continuity errors (and may drop data for). The first packet of each PID after a switch is also flagged as a
+    discontinuity when it carries an adaptation field, so decoders reset their timing.
+    """
+
+    def __init__(self):
+        self.last_counters = {}
+        self.offsets = {}
+
+    def start_new_source(self):
+        self.offsets = {}
+
+    def fix(self, data):
+        packets = bytearray(data)
+        for position in range(0, len(packets) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+            if packets[position] != TS_SYNC_BYTE:
+                continue
+            pid = ((packets[position + 1] & 0x1f) << 8) | packets[position + 2]
+            adaptation_field_control = (packets[position + 3] >> 4) & 0x3
+            # Null packets and packets without a payload do not increment the counter
+            if pid == 0x1fff or not adaptation_field_control & 0x1:
+                continue
+            counter = packets[position + 3] & 0x0f
+            offset = self.offsets.get(pid)
+            if offset is None:
+                last_counter = self.last_counters.get(pid)
+                offset = 0 if last_counter is None else (last_counter + 1 - counter) % 16
+                self.offsets[pid] = offset
+                if last_counter is not None and adaptation_field_control & 0x2 and packets[position + 4] > 0:
+                    packets[position + 5] |= 0x80
+            counter = (counter + offset) % 16
+            packets[position + 3] = (packets[position + 3] & 0xf0) | counter
+            self.last_counters[pid] = counter
+        return bytes(packets)
+
+
+class ChannelStream(FFmpegStream):
+    """
+    Relays a channel from the first of its sources that is working, in priority order.
+
+    When the current source stalls, drops below the minimum bitrate or ends, the next source is started and its
+    output is appended to the same buffer with the continuity counters carried on, so connected viewers keep
+    their connection and only see a short gap.
+    FFmpeg reads the input at its native rate here so that output arrives steadily enough to detect a stall quickly.
+    """
+
+    def __init__(self, channel_id, source_urls):
+        super().__init__(f'channel:{channel_id}')
+        self.channel_id = channel_id
+        self.source_urls = source_urls
+        self.source_index = 0
+        self.failovers = 0
+        self.continuity_counters = ContinuityCounterFixer()
+
+    def ffmpeg_command(self, url):
+        command = super().ffmpeg_command(url)
+        command.insert(command.index('-i'), '-re')
+        return command
+
+    async def run_ffmpeg(self):
+        failed_rounds = 0
+        round_received = 0
+        try:
+            while self.running:
+                url = self.source_urls[self.source_index]
+                shared_stream = active_streams.get(url)
+                if shared_stream is not None and shared_stream.running and shared_stream is not self:
+                    # This source is already being relayed (eg. for a TVHeadend mux). Read from it rather than
+                    # opening another upstream connection. It holds the connection slot.
+                    self.slot_ready.set()
+                    round_received += await self.relay_shared_source(url, shared_stream)
+                else:
+                    # Only the first source may wait for a connection slot. Failovers skip sources with none free.
+                    wait_timeout = None if not self.slot_ready.is_set() and self.source_index == 0 else 0
+                    acquired, playlist_id, session_url = await acquire_connection_slot(url, self,
+                                                                                       wait_timeout=wait_timeout)
+                    if acquired:
+                        self.slot = (playlist_id, session_url)
+                        self.slot_ready.set()
+                        try:
+                            round_received += await self.relay_source(url)
+                        finally:
+                            await connection_slots.release(*self.slot, self)
+                            self.slot = None
+                    else:
+                        ffmpeg_logger.warning("No connection slot free for channel #%s source '%s'", self.channel_id,
+                                              url)
+                if not self.running:
+                    break
+
+                # Move on to the next source
+                self.source_index = (self.source_index + 1) % len(self.source_urls)
+                if self.source_index == 0:
+                    if not self.slot_ready.is_set():
+                        # Never got a connection slot for any of the sources
+                        break
+                    failed_rounds = 0 if round_received else failed_rounds + 1
+                    round_received = 0
+                    if failed_rounds >= hls_proxy_failover_max_rounds:
+                        ffmpeg_logger.error("All sources for channel #%s have failed, ending relay", self.channel_id)
+                        break
+                    if failed_rounds:
+                        await asyncio.sleep(1)
+                self.failovers += 1
+                self.continuity_counters.start_new_source()
+                ffmpeg_logger.info("Channel #%s failing over to source %s: '%s'", self.channel_id,
+                                   self.source_index + 1, self.source_urls[self.source_index])
+            if not self.slot_ready.is_set():
+                self.rejected = True
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            ffmpeg_logger.error("Error relaying channel #%s: %s", self.channel_id, e)
+        finally:
+            await self.cleanup()
+
+    async def relay_source(self, url):
+        """
+        Relay one source with a new FFmpeg process. Returns the bytes relayed.
+        While it runs, the relay is also registered as the shared stream for the source URL, so that stream relay
+        clients of the same URL (eg. TVHeadend muxes) join it instead of opening another upstream connection.
+        Those clients are disconnected when the relay moves off the source, as the next source has different
+        programs and PIDs.
+        """
+        stderr_task = await self.start_process(url)
+        if url not in active_streams or not active_streams[url].running:
+            active_streams[url] = self
+        try:
+            return await self.relay_output(url, lambda: self.process.stdout.read(65536),
+                                           hls_proxy_failover_stall_timeout)
+        finally:
+            if active_streams.get(url) is self:
+                del active_streams[url]
+            self.disconnect_source_readers(url)
+            stderr_task.cancel()
+            await self.terminate_process()
+
+    def disconnect_source_readers(self, url):
+        """Disconnect the readers that joined this relay through one of its source URLs rather than the channel."""
+        for reader in self.readers.values():
+            if reader.source_url == url:
+                ffmpeg_logger.info("Channel #%s is leaving source '%s', disconnecting reader %s", self.channel_id,
+                                   url, reader.reader_id)
+                self.buffer.disconnect_reader(reader)
+
+    async def relay_shared_source(self, url, shared_stream):
+        """Relay one source from the shared stream already running for it. Returns the bytes relayed."""
+        reader_id = f'channel:{self.channel_id}'
+        reader = shared_stream.add_reader(reader_id)
+
+        async def read_chunk():
+            while True:
+                data = shared_stream.buffer.read(reader)
+                if data or reader.disconnected or not shared_stream.running:
+                    return data
+                await shared_stream.buffer.wait_for_data(reader)
+
+        try:
+            await shared_stream.slot_ready.wait()
+            if shared_stream.rejected:
+                return 0
+            # Shared streams are not read at the native rate, so segmented inputs arrive in bursts.
+            # Allow the longer start timeout between chunks before calling it a stall.
+            return await self.relay_output(url, read_chunk, hls_proxy_failover_start_timeout)
+        finally:
+            shared_stream.remove_reader(reader_id)
+
+    async def relay_output(self, url, read_chunk, stall_timeout):
+        """Append a source's output until it stops, stalls or drops below the minimum bitrate."""
+        received = 0
+        window_start = time.time()
+        window_bytes = 0
+        timeout = hls_proxy_failover_start_timeout
+        self.partial_packet = b''
+        while self.running:
+            try:
+                chunk = await asyncio.wait_for(read_chunk(), timeout=timeout)
+            except asyncio.TimeoutError:
+                ffmpeg_logger.warning("Channel #%s source '%s' stalled for %s seconds", self.channel_id, url,
+                                      timeout)
+                break
+            if not chunk:
+                ffmpeg_logger.warning("Channel #%s source '%s' has finished streaming", self.channel_id, url)
+                break
+            if not received:
+                # The source has started. From here on, a much shorter gap counts as a stall.
+                timeout = stall_timeout
+                window_start = time.time()
+            self.last_activity = time.time()
+            self.last_packet_at = self.last_activity
+            received += len(chunk)
+            window_bytes += len(chunk)
+            if self.partial_packet:
+                chunk = self.partial_packet + chunk
+            aligned_length = len(chunk) - (len(chunk) % TS_PACKET_SIZE)
+            self.partial_packet = chunk[aligned_length:]
+            if aligned_length:
+                self.buffer.append(self.continuity_counters.fix(chunk[:aligned_length]))
+
+            elapsed = self.last_activity - window_start
+            if elapsed >= 5:
+                bitrate = window_bytes * 8 / elapsed
+                if bitrate < hls_proxy_failover_min_bitrate:
+                    ffmpeg_logger.warning("Channel #%s source '%s' bitrate dropped to %d bits/s", self.channel_id,
+                                          url, bitrate)
+                    break
+                window_start = self.last_activity
+                window_bytes = 0
+        return received
+
+    def stats(self):
+        stats = super().stats()
+        stats['channel_id'] = self.channel_id
+        stats['source_index'] = self.source_index
+        stats['failovers'] = self.failovers
+        return stats
 
 
-class TimeBuffer:
-    def __init__(self, duration=60):  # Duration in seconds
-        self.duration = duration
-        self.buffer = deque()  # Use deque to hold (timestamp, chunk) tuples
-        self.lock = threading.Lock()
+class HlsRepackager(FFmpegStream):
+    """
+    Repackages one upstream stream into a local live HLS rendition that is shared by every client watching it.
+
+    FFmpeg copies the stream into a rolling window of segments and a live manifest in a directory on tmpfs, so the
+    upstream is pulled once no matter how many HLS clients are watching. Segments that fall out of the window are
+    deleted by FFmpeg. The repackager stops once no client has requested the manifest or a segment for a while.
+    """
+
+    def __init__(self, decoded_url):
+        super().__init__(decoded_url)
+        self.output_path = os.path.join(hls_proxy_repackage_path,
+                                        hashlib.sha1(decoded_url.encode('utf-8')).hexdigest())
+        self.manifest_path = os.path.join(self.output_path, 'index.m3u8')
+        self.manifest_opened = False
+        self.manifest_ready = asyncio.Event()
+        self.last_requested = time.time()
+
+    def ffmpeg_command(self, url):
+        return [
+            'ffmpeg', '-hide_banner', '-loglevel', 'info', '-err_detect', 'ignore_err',
+            '-progress', 'pipe:2', '-nostats',
+            '-probesize', '20M', '-analyzeduration', '0', '-fpsprobesize', '0',
+            '-i', url,
+            '-c', 'copy',
+            '-f', 'hls',
+            '-hls_time', str(hls_proxy_repackage_segment_duration),
+            '-hls_list_size', str(hls_proxy_repackage_segment_count),
+            '-hls_flags', 'delete_segments+temp_file+omit_endlist',
+            '-hls_segment_filename', os.path.join(self.output_path, 'seg%06d.ts'),
+            self.manifest_path
+        ]
+
+    def touch(self):
+        self.last_requested = time.time()
+
+    def handle_stderr_line(self, line):
+        super().handle_stderr_line(line)
+        if self.manifest_ready.is_set():
+            return
+        # The HLS muxer logs "Opening '<manifest>.tmp' for writing" when it writes the first manifest (once the
+        # first segment is complete) and renames it into place straight after. Look for the file from then on.
+        if not self.manifest_opened:
+            self.manifest_opened = f"'{self.manifest_path}" in line
+        if self.manifest_opened and os.path.exists(self.manifest_path):
+            self.manifest_ready.set()
+
+    async def run_ffmpeg(self):
+        stderr_task = None
+        try:
+            acquired, playlist_id, session_url = await acquire_connection_slot(self.decoded_url, self)
+            if not acquired:
+                self.rejected = True
+                return
+            self.slot = (playlist_id, session_url)
+            self.slot_ready.set()
+            await asyncio.to_thread(os.makedirs, self.output_path, exist_ok=True)
+            stderr_task = await self.start_process(self.decoded_url)
+            while self.running:
+                try:
+                    await asyncio.wait_for(self.process.wait(), timeout=1)
+                    ffmpeg_logger.warning("FFmpeg has finished repackaging '%s'", self.decoded_url)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+                if time.time() - self.last_requested > hls_proxy_repackage_idle_timeout:
+                    ffmpeg_logger.info("No clients have requested the HLS rendition of '%s' recently, stopping",
+                                       self.decoded_url)
+                    break
+                stall_reason = self.stall_reason()
+                if stall_reason:
+                    ffmpeg_logger.warning("FFmpeg repackaging of '%s' has stalled (%s), stopping",
+                                          self.decoded_url, stall_reason)
+                    self.stalls += 1
+                    metrics.inc('stream_stalls', type(self).__name__)
+                    break
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            ffmpeg_logger.error("Error repackaging '%s': %s", self.decoded_url, e)
+        finally:
+            if stderr_task:
+                stderr_task.cancel()
+            await self.cleanup()
+
+    async def cleanup(self):
+        await super().cleanup()
+        # Wake any requests still waiting for the first manifest
+        self.manifest_ready.set()
+        if hls_repackagers.get(self.decoded_url) is self:
+            del hls_repackagers[self.decoded_url]
+        await asyncio.to_thread(shutil.rmtree, self.output_path, True)
+
+    async def wait_for_manifest(self, timeout):
+        """Wait for FFmpeg to write the first manifest. Returns False if the repackager stopped or timed out first."""
+        try:
+            await asyncio.wait_for(self.manifest_ready.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return False
+        return self.running
+
+    async def read_file(self, file_name):
+        """Return the contents of a file in the rendition, or None if it does not exist (anymore)."""
+
+        def read():
+            try:
+                with open(os.path.join(self.output_path, file_name), 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                return None
+
+        return await asyncio.to_thread(read)
+
+
+class StreamReader:
+    """
+    A cursor into a StreamRingBuffer for a single connection.
+    Positions are absolute byte offsets into the stream, so a reader never holds a copy of the data.
+    """
+
+    def __init__(self, reader_id, seq, offset, pending=None):
+        self.reader_id = reader_id
+        self.seq = seq  # Sequence number of the next chunk to read
+        self.offset = offset  # Absolute stream offset of the next byte to read
+        self.pending = pending  # Data to send before continuing from the cursor (eg. a join at a keyframe)
+        self.dropped_bytes = 0  # Bytes this reader missed because it lagged too far behind the live edge
+        self.lag_events = 0  # Number of times the lag policy has been applied to this reader
+        self.disconnected = False  # Set when the lag policy (or the stream) decides this reader should be closed
+        self.source_url = None  # The URL this reader's connection asked for, when it joined a stream relay
+        self.connected_at = time.time()
+        self.bytes_sent = 0
+
+
+class StreamRingBuffer:
+    """
+    A byte-bounded buffer of stream chunks shared by every reader of one stream.
+
+    Each chunk is stored exactly once. Once the buffer grows beyond max_bytes the oldest chunks are discarded.
+    Readers that are too slow to keep up fall off the tail, are reported and are moved forward to the oldest
+    chunk still held.
+
+    All access happens on the event loop, so no locking is needed. Readers waiting for data are woken as soon
+    as a chunk is appended.
+
+    Appended chunks must be whole MPEG-TS packets. The latest PAT and PMT packets and the position of the latest
+    video keyframe (a packet with the random access indicator set) are tracked, so that a new reader joining a
+    running stream can start from the keyframe and begin decoding straight away. A keyframe is only used as a
+    join point once the PAT and every PMT it lists have been seen.
+    """
+
+    def __init__(self, max_bytes=hls_proxy_stream_buffer_bytes):
+        self.max_bytes = max_bytes
+        self.chunks = deque()
+        self.first_seq = 0  # Sequence number of the oldest chunk held
+        self.tail_offset = 0  # Absolute stream offset of the oldest byte held
+        self.head_offset = 0  # Absolute stream offset of the next byte to be appended
+        self.size = 0
+        self.slow_reader_drops = 0
+        self.closed = False
+        self._data_event = asyncio.Event()
+        self.pat_packet = None
+        self.pmt_pids = set()  # PMT PIDs listed in the latest PAT
+        self.pmt_packets = {}  # PMT PID -> latest PMT packet (only for PMTs that have been seen)
+        self.video_pids = set()
+        # (chunk sequence number, packet position within chunk, chunk start offset, PAT and PMT packets)
+        self.last_keyframe = None
+        self.max_reader_lag = hls_proxy_client_max_lag_bytes
+        self.lag_policy = hls_proxy_client_lag_policy
+
+    @property
+    def next_seq(self):
+        return self.first_seq + len(self.chunks)
+
+    def create_reader(self, reader_id):
+        reader = StreamReader(reader_id, self.next_seq, self.head_offset)
+        # Start from the latest keyframe still in the buffer if there is one. Otherwise start at the live edge.
+        self._seek_to_keyframe(reader)
+        return reader
+
+    def _seek_to_keyframe(self, reader):
+        """Move a reader to the latest keyframe in the buffer, preceded by the stream's PAT and PMT."""
+        if self.last_keyframe is None or self.last_keyframe[0] < self.first_seq:
+            return False
+        keyframe_seq, keyframe_position, chunk_offset, tables = self.last_keyframe
+        keyframe_chunk = self.chunks[keyframe_seq - self.first_seq]
+        reader.pending = tables + keyframe_chunk[keyframe_position:]
+        reader.seq = keyframe_seq + 1
+        reader.offset = chunk_offset + len(keyframe_chunk)
+        return True
+
+    def reader_lag(self, reader):
+        """Number of bytes between a reader's cursor and the live edge of the stream."""
+        return self.head_offset - reader.offset + len(reader.pending or b'')
+
+    def _apply_lag_policy(self, reader):
+        lag = self.head_offset - reader.offset
+        reader.lag_events += 1
+        self.slow_reader_drops += 1
+        if self.lag_policy == 'disconnect':
+            buffer_logger.warning("[Buffer] Reader %s is %d bytes behind the live edge. Disconnecting it.",
+                                  reader.reader_id, lag)
+            reader.disconnected = True
+            return
+        start_offset = reader.offset
+        # Only skip to the keyframe if it is ahead of this reader. Otherwise fall back to dropping the oldest data.
+        if self.lag_policy != 'skip_to_keyframe' or self.last_keyframe is None or \
+                self.last_keyframe[0] < reader.seq or not self._seek_to_keyframe(reader):
+            while reader.seq < self.next_seq and self.head_offset - reader.offset > self.max_reader_lag:
+                reader.offset += len(self.chunks[reader.seq - self.first_seq])
+                reader.seq += 1
+        reader.dropped_bytes += reader.offset - start_offset
+        buffer_logger.warning("[Buffer] Reader %s was %d bytes behind the live edge and skipped %d bytes",
+                              reader.reader_id, lag, reader.offset - start_offset)
+
+    def _parse_pat(self, packet, payload_start):
+        # Skip the pointer field, then the table header (8 bytes) up to the program loop
+        section_start = payload_start + 1 + packet[payload_start]
+        section_length = ((packet[section_start + 1] & 0x0f) << 8) | packet[section_start + 2]
+        programs_end = min(section_start + 3 + section_length - 4, TS_PACKET_SIZE)
+        pmt_pids = set()
+        for i in range(section_start + 8, programs_end - 3, 4):
+            program_number = (packet[i] << 8) | packet[i + 1]
+            if program_number != 0:
+                pmt_pids.add(((packet[i + 2] & 0x1f) << 8) | packet[i + 3])
+        # Forget the PMTs of programs that are no longer listed
+        self.pmt_pids = pmt_pids
+        self.pmt_packets = {pid: packet for pid, packet in self.pmt_packets.items() if pid in pmt_pids}
+
+    def _parse_pmt(self, packet, payload_start):
+        section_start = payload_start + 1 + packet[payload_start]
+        section_length = ((packet[section_start + 1] & 0x0f) << 8) | packet[section_start + 2]
+        streams_end = min(section_start + 3 + section_length - 4, TS_PACKET_SIZE)
+        program_info_length = ((packet[section_start + 10] & 0x0f) << 8) | packet[section_start + 11]
+        i = section_start + 12 + program_info_length
+        video_pids = set()
+        while i + 5 <= streams_end:
+            stream_type = packet[i]
+            elementary_pid = ((packet[i + 1] & 0x1f) << 8) | packet[i + 2]
+            es_info_length = ((packet[i + 3] & 0x0f) << 8) | packet[i + 4]
+            if stream_type in TS_VIDEO_STREAM_TYPES:
+                video_pids.add(elementary_pid)
+            i += 5 + es_info_length
+        self.video_pids = video_pids
+
+    def _record_keyframe(self, seq, position, chunk_offset):
+        # A reader joining here needs the PAT and all of its PMTs before the keyframe to decode the stream
+        if self.pat_packet is None or not self.pmt_pids or len(self.pmt_packets) < len(self.pmt_pids):
+            return
+        tables = b''.join([self.pat_packet] + [self.pmt_packets[pid] for pid in sorted(self.pmt_pids)])
+        self.last_keyframe = (seq, position, chunk_offset, tables)
+
+    def _scan_chunk(self, chunk, seq, chunk_offset):
+        """Record PAT/PMT packets and keyframe positions found in a newly appended chunk."""
+        # Only packets that start a payload unit (PUSI set) can carry a table or the start of a keyframe.
+        # Slice out the second byte of every packet to find those without walking the whole chunk.
+        for index, flags in enumerate(chunk[1::TS_PACKET_SIZE]):
+            if not flags & 0x40:
+                continue
+            position = index * TS_PACKET_SIZE
+            if chunk[position] != TS_SYNC_BYTE or position + TS_PACKET_SIZE > len(chunk):
+                continue
+            pid = ((flags & 0x1f) << 8) | chunk[position + 2]
+            adaptation_field_control = (chunk[position + 3] >> 4) & 0x3
+            payload_start = position + 4
+            if adaptation_field_control & 0x2:
+                adaptation_field_length = chunk[position + 4]
+                payload_start += 1 + adaptation_field_length
+                random_access = adaptation_field_length > 0 and chunk[position + 5] & 0x40
+                if random_access and (pid in self.video_pids or not self.video_pids):
+                    self._record_keyframe(seq, position, chunk_offset)
+            if not adaptation_field_control & 0x1 or payload_start >= position + TS_PACKET_SIZE:
+                continue
+            try:
+                if pid == 0:
+                    self.pat_packet = chunk[position:position + TS_PACKET_SIZE]
+                    self._parse_pat(self.pat_packet, payload_start - position)
+                elif pid in self.pmt_pids:
+                    self.pmt_packets[pid] = chunk[position:position + TS_PACKET_SIZE]
+                    self._parse_pmt(self.pmt_packets[pid], payload_start - position)
+            except IndexError:
+                # A table that does not fit in a single packet. Keep what we have.
+                pass
+
+    def _notify_readers(self):
+        # Wake everything waiting on the current event and hand out a fresh one for the next wait
+        self._data_event.set()
+        self._data_event = asyncio.Event()
 
     def append(self, chunk):
-        current_time = time.time()
-        with self.lock:
-            # Append the current time and chunk to the buffer
-            self.buffer.append((current_time, chunk))
-            buffer_logger.debug("[Buffer] Appending chunk at time %f", current_time)
-
-            # Remove chunks older than the specified duration
-            while self.buffer and (current_time - self.buffer[0][0]) > self.duration:
-                buffer_logger.info("[Buffer] Removing chunk older than %d seconds", self.duration)
-                self.buffer.popleft()  # Remove oldest chunk
-
-    def read(self):
-        with self.lock:
-            if self.buffer:
-                # Return the oldest chunk
-                return self.buffer.popleft()[1]  # Return the chunk, not the timestamp
+        self._scan_chunk(chunk, self.next_seq, self.head_offset)
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        self.head_offset += len(chunk)
+        buffer_logger.debug("[Buffer] Appending chunk of %d bytes at offset %d", len(chunk), self.head_offset)
+
+        # Discard the oldest chunks once the buffer is over its byte limit (always keep the latest chunk)
+        while self.size > self.max_bytes and len(self.chunks) > 1:
+            oldest_chunk = self.chunks.popleft()
+            self.size -= len(oldest_chunk)
+            self.tail_offset += len(oldest_chunk)
+            self.first_seq += 1
+
+        self._notify_readers()
+
+    def read(self, reader):
+        if reader.disconnected:
+            return b''
+        if reader.pending:
+            pending = reader.pending
+            reader.pending = None
+            return pending
+        if reader.seq < self.first_seq:
+            # This reader has fallen off the tail of the buffer. Report it and skip it forward.
+            dropped = self.tail_offset - reader.offset
+            reader.dropped_bytes += dropped
+            reader.lag_events += 1
+            self.slow_reader_drops += 1
+            buffer_logger.warning("[Buffer] Reader %s fell behind the stream buffer and skipped %d bytes",
+                                  reader.reader_id, dropped)
+            reader.seq = self.first_seq
+            reader.offset = self.tail_offset
+        if 0 < self.max_reader_lag < self.head_offset - reader.offset:
+            self._apply_lag_policy(reader)
+            if reader.disconnected:
+                return b''
+            if reader.pending:
+                pending = reader.pending
+                reader.pending = None
+                return pending
+        if reader.seq >= self.next_seq:
             return b''  # Return empty bytes if no data
+        chunk = self.chunks[reader.seq - self.first_seq]
+        reader.seq += 1
+        reader.offset += len(chunk)
+        return chunk
+
+    def disconnect_reader(self, reader):
+        """Close a reader, waking it if it is waiting for data."""
+        reader.disconnected = True
+        self._notify_readers()
+
+    async def wait_for_data(self, reader):
+        """Wait until there is data after this reader's cursor or the buffer is closed."""
+        while reader.seq >= self.next_seq and not self.closed and not reader.disconnected:
+            await self._data_event.wait()
+
+    def close(self):
+        self.closed = True
+        self.first_seq = self.next_seq
+        self.tail_offset = self.head_offset
+        self.chunks.clear()
+        self.size = 0
+        self.last_keyframe = None
+        self._notify_readers()
+
+
+class DiskSegmentCache:
+    """
+    An optional on-disk second tier for the segment cache.
 
+    Segments evicted from memory that have not yet expired are spilled here, bounded by max_bytes with the least
+    recently used files removed first. Hits are streamed from memory-mapped files. The index is only held in
+    memory, so any files left in the directory from a previous run are stale and are removed at startup.
+    Point the path at a tmpfs mount to keep segments off physical disks. Files are kept in their own directory
+    under the path.
+    """
 
-class Cache:
-    def __init__(self, ttl=3600):
-        self.cache = {}
-        self.expiration_times = {}
-        self._lock = asyncio.Lock()
-        self.ttl = ttl
-        self.max_size = 100  # Limit cache size to prevent memory issues
+    directory_name = 'tic-segment-cache'
+
+    def __init__(self, path, max_bytes=0):
+        self.path = os.path.join(path, self.directory_name)
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (file_path, size, expires_at), ordered from least to most recently used
+        self.size = 0
+        self.hits = 0
+        self.evictions = 0
+        self.spills = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _file_path(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _remove(self, key):
+        file_path, size, expires_at = self.entries.pop(key)
+        self.size -= size
+        return file_path
+
+    @staticmethod
+    def _write_file(file_path, value):
+        # Write to a temporary file first so that a file is never read part way through being written
+        tmp_file_path = f"{file_path}.tmp"
+        with open(tmp_file_path, 'wb') as f:
+            f.write(value)
+        os.replace(tmp_file_path, file_path)
+
+    @staticmethod
+    def _remove_files(file_paths):
+        for file_path in file_paths:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+    async def set(self, key, value, expires_at):
+        size = len(value)
+        if not self.enabled or size == 0 or size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        file_path = self._file_path(key)
+        try:
+            await asyncio.to_thread(self._write_file, file_path, value)
+        except Exception as e:
+            proxy_logger.error("[DISK CACHE] Failed to write '%s' to disk: %s", key, e)
+            return
+        self.entries[key] = (file_path, size, expires_at)
+        self.size += size
+        self.spills += 1
+        # Remove the least recently used files until we are back within budget
+        removed_file_paths = []
+        while self.size > self.max_bytes:
+            oldest_key = next(iter(self.entries))
+            removed_file_paths.append(self._remove(oldest_key))
+            self.evictions += 1
+        if removed_file_paths:
+            await asyncio.to_thread(self._remove_files, removed_file_paths)
+
+    def get_file_path(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        file_path, size, expires_at = entry
+        if time.time() > expires_at:
+            self._remove(key)
+            asyncio.create_task(asyncio.to_thread(self._remove_files, [file_path]))
+            return None
+        self.entries.move_to_end(key)
+        return file_path
+
+    @staticmethod
+    def _open_mmap(file_path):
+        with open(file_path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    async def open_file(self, key):
+        """
+        Return a read-only memory map of the file holding this key, or None if it is not cached.
+        The file may be evicted between looking it up and opening it. That is treated as a miss.
+        """
+        file_path = self.get_file_path(key)
+        if file_path is None:
+            return None
+        try:
+            mapped_file = await asyncio.to_thread(self._open_mmap, file_path)
+        except FileNotFoundError:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == file_path:
+                self._remove(key)
+            return None
+        self.hits += 1
+        return mapped_file
+
+    def exists(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and time.time() <= entry[2]
 
-    async def _cleanup_expired_items(self):
+    @staticmethod
+    async def iter_file(mapped_file, chunk_size=65536):
+        """Yield the contents of a cached file from its memory map, closing it once done."""
+        try:
+            for offset in range(0, len(mapped_file), chunk_size):
+                yield mapped_file[offset:offset + chunk_size]
+        finally:
+            mapped_file.close()
+
+    async def evict_expired_items(self):
         current_time = time.time()
-        expired_keys = [k for k, exp in self.expiration_times.items() if current_time > exp]
-        for k in expired_keys:
-            if isinstance(self.cache.get(k), FFmpegStream):
-                try:
-                    self.cache[k].stop()
-                except Exception:
-                    pass
-            self.cache.pop(k, None)
-            self.expiration_times.pop(k, None)
+        expired_keys = [k for k, (f, size, exp) in self.entries.items() if current_time > exp]
+        removed_file_paths = [self._remove(k) for k in expired_keys]
+        if removed_file_paths:
+            await asyncio.to_thread(self._remove_files, removed_file_paths)
         return len(expired_keys)
 
+    def clear_stale_files(self):
+        """Remove the cache files left in the cache directory. Only call this before the cache is in use."""
+        if not self.enabled:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with os.scandir(self.path) as entries:
+            stale_file_paths = [entry.path for entry in entries
+                                if entry.is_file(follow_symlinks=False) and CACHE_FILE_NAME_RE.match(entry.name)]
+        self._remove_files(stale_file_paths)
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            'entries':   len(self.entries),
+            'size':      self.size,
+            'max_bytes': self.max_bytes,
+            'hits':      self.hits,
+            'spills':    self.spills,
+            'evictions': self.evictions,
+        }
+
+
+class SegmentCache:
+    """
+    A byte-budgeted LRU cache for proxied HLS segments and keys.
+
+    Entries are accounted by their size in bytes. When a new entry pushes the cache over max_bytes, the least
+    recently used entries are evicted in O(1) each. Reads never take a lock; everything runs on the event loop.
+    If a second tier is given, evicted entries that have not yet expired are spilled to it.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, ttl=3600, second_tier=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.second_tier = second_tier
+        self.entries = OrderedDict()  # key -> (value, size, expires_at), ordered from least to most recently used
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _remove(self, key):
+        value, size, expires_at = self.entries.pop(key)
+        self.size -= size
+
     async def get(self, key):
-        async with self._lock:
-            if key in self.cache and time.time() <= self.expiration_times.get(key, 0):
-                # Access refreshes TTL
-                self.expiration_times[key] = time.time() + self.ttl
-                return self.cache[key]
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, size, expires_at = entry
+        current_time = time.time()
+        if current_time > expires_at:
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
             return None
+        # Access refreshes TTL and marks the entry as most recently used
+        self.entries[key] = (value, size, current_time + self.ttl)
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
 
     async def set(self, key, value, expiration_time=None):
-        async with self._lock:
-            await self._cleanup_expired_items()
-            if len(self.cache) >= self.max_size and self.expiration_times:
-                oldest_key = min(self.expiration_times.items(), key=lambda x: x[1])[0]
-                if isinstance(self.cache.get(oldest_key), FFmpegStream):
-                    try:
-                        self.cache[oldest_key].stop()
-                    except Exception:
-                        pass
-                self.cache.pop(oldest_key, None)
-                self.expiration_times.pop(oldest_key, None)
-            ttl = expiration_time if expiration_time is not None else self.ttl
-            self.cache[key] = value
-            self.expiration_times[key] = time.time() + ttl
+        if key in self.entries:
+            self._remove(key)
+        size = len(value)
+        if size > self.max_bytes:
+            proxy_logger.warning("[CACHE] Not caching '%s', its size (%d bytes) exceeds the cache budget", key, size)
+            return
+        ttl = expiration_time if expiration_time is not None else self.ttl
+        current_time = time.time()
+        self.entries[key] = (value, size, current_time + ttl)
+        self.size += size
+        # Evict the least recently used entries until we are back within budget
+        spilled_entries = []
+        while self.size > self.max_bytes:
+            oldest_key = next(iter(self.entries))
+            oldest_value, oldest_size, oldest_expires_at = self.entries[oldest_key]
+            self._remove(oldest_key)
+            self.evictions += 1
+            if oldest_expires_at > current_time:
+                spilled_entries.append((oldest_key, oldest_value, oldest_expires_at))
+        if self.second_tier is not None and self.second_tier.enabled:
+            for spilled_key, spilled_value, spilled_expires_at in spilled_entries:
+                await self.second_tier.set(spilled_key, spilled_value, spilled_expires_at)
+
+    async def open_file(self, key):
+        """Return a memory map of the second tier file holding this key, or None if it is not on disk."""
+        if self.second_tier is None or not self.second_tier.enabled:
+            return None
+        return await self.second_tier.open_file(key)
 
     async def exists(self, key):
-        async with self._lock:
-            await self._cleanup_expired_items()
-            return key in self.cache
+        entry = self.entries.get(key)
+        if entry is not None and time.time() <= entry[2]:
+            return True
+        return self.second_tier is not None and self.second_tier.exists(key)
 
     async def evict_expired_items(self):
-        async with self._lock:
-            return await self._cleanup_expired_items()
+        current_time = time.time()
+        expired_keys = [k for k, (v, size, exp) in self.entries.items() if current_time > exp]
+        for k in expired_keys:
+            self._remove(k)
+        self.expirations += len(expired_keys)
+        if self.second_tier is not None and self.second_tier.enabled:
+            return len(expired_keys) + await self.second_tier.evict_expired_items()
+        return len(expired_keys)
+
+    def stats(self):
+        return {
+            'entries':     len(self.entries),
+            'size':        self.size,
+            'max_bytes':   self.max_bytes,
+            'hits':        self.hits,
+            'misses':      self.misses,
+            'evictions':   self.evictions,
+            'expirations': self.expirations,
+        }
+
 
 async def periodic_cache_cleanup():
     while True:
@@ -256,6 +1410,11 @@ async def periodic_cache_cleanup():
             evicted_count = await cache.evict_expired_items()
             if evicted_count > 0:
                 proxy_logger.info(f"Cache cleanup: evicted {evicted_count} expired items")
+            proxy_logger.debug("Cache stats: %s", cache.stats())
+            if disk_cache.enabled:
+                proxy_logger.debug("Disk cache stats: %s", disk_cache.stats())
+            for stream in list(active_streams.values()):
+                buffer_logger.debug("Stream stats: %s", stream.stats())
             
             # Log current memory usage (optional)
             try:
@@ -274,34 +1433,511 @@ async def periodic_cache_cleanup():
 
 
 # Global cache instance (short default TTL for HLS segments)
-cache = Cache(ttl=120)
+disk_cache = DiskSegmentCache(hls_proxy_disk_cache_path, max_bytes=hls_proxy_disk_cache_max_bytes)
+cache = SegmentCache(max_bytes=hls_proxy_cache_max_bytes, ttl=120, second_tier=disk_cache)
+
+# App-lifetime connection pool used for all upstream requests made by the proxy
+proxy_session = None
+
 
-# Register a startup hook to launch the periodic cache cleanup task once the app is ready.
+def get_proxy_session():
+    """
+    Return the shared upstream client session, creating it if needed.
+    Connections are kept alive and DNS lookups are cached between segment requests.
+    """
+    global proxy_session
+    if proxy_session is None or proxy_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=hls_proxy_upstream_connections,
+            limit_per_host=hls_proxy_upstream_connections_per_host,
+            ttl_dns_cache=hls_proxy_dns_cache_ttl,
+            keepalive_timeout=hls_proxy_keepalive_timeout,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            connect=hls_proxy_connect_timeout,
+            sock_read=hls_proxy_read_timeout,
+        )
+        proxy_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return proxy_session
+
+
+async def close_proxy_session():
+    global proxy_session
+    if proxy_session is not None and not proxy_session.closed:
+        await proxy_session.close()
+    proxy_session = None
+
+
+def clear_stale_renditions():
+    """Remove the rendition directories left under the repackage path. Anything else there is left alone."""
+    if not os.path.isdir(hls_proxy_repackage_path):
+        return
+    with os.scandir(hls_proxy_repackage_path) as entries:
+        stale_paths = [entry.path for entry in entries
+                       if entry.is_dir(follow_symlinks=False) and CACHE_FILE_NAME_RE.match(entry.name)]
+    for path in stale_paths:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+# Register startup and shutdown hooks to manage the periodic cache cleanup task and the upstream connection pool.
 @blueprint.record_once
 def _register_startup(state):
     app = state.app
 
     @app.before_serving
     async def _start_periodic_cache_cleanup():
+        # Files left in the disk cache by a previous run are not indexed, so they can never be served
+        await asyncio.to_thread(disk_cache.clear_stale_files)
         asyncio.create_task(periodic_cache_cleanup())
 
+    @app.before_serving
+    async def _clear_hls_repackage_path():
+        # Renditions left by a previous run are no longer being updated
+        await asyncio.to_thread(clear_stale_renditions)
+
+    @app.before_serving
+    async def _open_proxy_session():
+        get_proxy_session()
+
+    @app.after_serving
+    async def _close_proxy_session():
+        await close_proxy_session()
+
+
+class SegmentDownload:
+    """
+    A single upstream download of a segment or key.
+
+    The body is streamed to every attached client as it arrives from upstream, while also being collected so that
+    it can be written to the cache once complete. Clients that request the same URL while the download is still
+    in progress attach to it rather than starting a new upstream fetch.
+    """
+
+    def __init__(self, url, expiration_time=30):
+        self.url = url
+        self.expiration_time = expiration_time
+        self.chunks = []
+        self.status = None
+        self.complete = False
+        self.failed = False
+        self.response_ready = asyncio.Event()
+        self._data_event = asyncio.Event()
+        self.task = None
+        self.clients = 0
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def _notify_readers(self):
+        # Wake everything waiting on the current event and hand out a fresh one for the next wait
+        self._data_event.set()
+        self._data_event = asyncio.Event()
+
+    async def run(self):
+        started = time.perf_counter()
+        metrics.inc('upstream_fetches', 'segment')
+        url_entry = url_registry.get_by_url(self.url)
+        if url_entry is not None:
+            url_entry.upstream_fetches += 1
+        try:
+            session = get_proxy_session()
+            async with session.get(self.url) as resp:
+                self.status = resp.status
+                metrics.observe('upstream_response_seconds', 'segment', time.perf_counter() - started)
+                if resp.status != 200:
+                    proxy_logger.error("Failed to fetch URL '%s' - status %s", self.url, resp.status)
+                    metrics.inc('upstream_errors', 'segment')
+                    self.failed = True
+                    return
+                self.response_ready.set()
+                async for chunk in resp.content.iter_chunked(65536):
+                    self.chunks.append(chunk)
+                    self._notify_readers()
+            metrics.observe('upstream_download_seconds', 'segment', time.perf_counter() - started)
+            metrics.inc('upstream_bytes', 'segment', sum(len(chunk) for chunk in self.chunks))
+            await cache.set(self.url, b''.join(self.chunks), expiration_time=self.expiration_time)
+            proxy_logger.info("[CACHE] Saved URL '%s' to cache", self.url)
+            self.complete = True
+        except asyncio.CancelledError:
+            self.failed = True
+        except Exception as e:
+            proxy_logger.error("Failed to fetch URL '%s': %s", self.url, e)
+            metrics.inc('upstream_errors', 'segment')
+            self.failed = True
+        finally:
+            self.response_ready.set()
+            self._notify_readers()
+            if inflight_downloads.get(self.url) is self:
+                del inflight_downloads[self.url]
+
+    async def wait_for_response(self):
+        """Wait for the upstream response. Returns True if a body is going to be streamed."""
+        await self.response_ready.wait()
+        return not (self.failed and self.status != 200)
+
+    async def iter_chunks(self):
+        """Yield the body from the start, waiting for more data from upstream until the download finishes."""
+        index = 0
+        self.clients += 1
+        try:
+            while True:
+                while index < len(self.chunks):
+                    yield self.chunks[index]
+                    index += 1
+                if self.complete or self.failed:
+                    break
+                await self._data_event.wait()
+        finally:
+            self.clients -= 1
+
+    async def wait_until_done(self):
+        await asyncio.shield(self.task)
+
+
+def get_inflight_download(url, expiration_time=30):
+    """
+    Return the in-progress upstream download for a URL, starting one if none is running.
+    All concurrent cache misses for the same URL share this single download.
+    """
+    download = inflight_downloads.get(url)
+    if download is None:
+        download = SegmentDownload(url, expiration_time=expiration_time)
+        inflight_downloads[url] = download
+        download.start()
+    return download
+
+
+async def serve_with_cache(decoded_url, file_type, content_type):
+    """
+    Serve a file from the cache. Otherwise stream it to the client straight from a single shared upstream download.
+    """
+    url_entry = url_registry.get_by_url(decoded_url)
+    metrics.inc('requests', file_type)
+    cached_content = await cache.get(decoded_url)
+    if cached_content is not None:
+        proxy_logger.info("[HIT] Serving %s URL from cache: %s", file_type, decoded_url)
+        metrics.inc('cache_hits', file_type)
+        metrics.inc('cache_tier_hits', 'memory')
+        metrics.inc('bytes_served', file_type, len(cached_content))
+        if url_entry is not None:
+            url_entry.hits += 1
+            url_entry.bytes_served += len(cached_content)
+        return Response(cached_content, content_type=content_type)
+    cached_file = await cache.open_file(decoded_url)
+    if cached_file is not None:
+        proxy_logger.info("[HIT] Serving %s URL from disk cache: %s", file_type, decoded_url)
+        metrics.inc('cache_hits', file_type)
+        metrics.inc('cache_tier_hits', 'disk')
+        if url_entry is not None:
+            url_entry.hits += 1
+        return Response(count_bytes_served(DiskSegmentCache.iter_file(cached_file), file_type, url_entry),
+                        content_type=content_type)
+    if decoded_url in inflight_downloads:
+        proxy_logger.info("[WAIT] Serving %s URL '%s' from an in-progress download", file_type, decoded_url)
+        metrics.inc('cache_hits', file_type)
+        metrics.inc('cache_tier_hits', 'inflight')
+        if url_entry is not None:
+            url_entry.hits += 1
+    else:
+        proxy_logger.info("[MISS] Serving %s URL '%s' without cache", file_type, decoded_url)
+        metrics.inc('cache_misses', file_type)
+        if url_entry is not None:
+            url_entry.misses += 1
+    download = get_inflight_download(decoded_url)
+    if not await download.wait_for_response():
+        proxy_logger.error("Failed to fetch %s file '%s'", file_type, decoded_url)
+        return Response("Failed to fetch the file.", status=404)
+    return Response(count_bytes_served(download.iter_chunks(), file_type, url_entry), content_type=content_type)
+
+
+async def prefetch_segments(segment_urls, semaphore):
+    """
+    Download segments into the cache concurrently, limited by the given semaphore.
+    When cancelled, any of these downloads that no client has attached to are cancelled too.
+    """
+
+    async def prefetch(url):
+        async with semaphore:
+            if await cache.exists(url):
+                return
+            download = get_inflight_download(url)
+            try:
+                await download.wait_until_done()
+            except asyncio.CancelledError:
+                if not download.clients and download.task:
+                    download.task.cancel()
+                raise
+
+    await asyncio.gather(*[prefetch(url) for url in segment_urls])
+
+
+class UrlEntry:
+    """State held by the proxy for one upstream URL."""
+
+    def __init__(self, url):
+        self.url = url
+        self.parent_url = None  # The manifest this URL was found in, if any
+        self.playlist_id = None
+        self.playlist_id_resolved = False
+        self.requests = 0
+        self.last_requested = None
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+        self.upstream_fetches = 0
+
+
+class UrlRegistry:
+    """
+    Maps short, stable IDs to the upstream URLs referenced in rewritten manifests.
+
+    IDs are derived from a hash of the URL, so the same URL always gets the same ID and a manifest rewritten
+    on each poll does not change. Entries are kept in a bounded LRU table.
+    URLs that were not registered here (eg. channel URLs published to TVHeadend) are base64 encoded instead,
+    and both forms are accepted by the proxy routes.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def url_id(url):
+        digest = hashlib.blake2b(url.encode('utf-8'), digest_size=12).digest()
+        return base64.urlsafe_b64encode(digest).decode('utf-8')
+
+    def register(self, url, playlist_id=None, parent_url=None):
+        """Add a URL to the registry (or refresh it) and return its entry."""
+        url_id = self.url_id(url)
+        entry = self.entries.get(url_id)
+        if entry is None:
+            entry = UrlEntry(url)
+            self.entries[url_id] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(url_id)
+        if playlist_id is not None:
+            entry.playlist_id = playlist_id
+            entry.playlist_id_resolved = True
+        if parent_url is not None and parent_url != url:
+            entry.parent_url = parent_url
+        return url_id, entry
+
+    def get(self, url_id):
+        entry = self.entries.get(url_id)
+        if entry is not None:
+            self.entries.move_to_end(url_id)
+        return entry
+
+    def get_by_url(self, url):
+        return self.get(self.url_id(url))
+
+    def resolve(self, encoded_url):
+        """
+        Return the registry entry for an ID or base64 encoded URL taken from a proxy request path.
+        Returns None if the value is neither a known ID nor a valid base64 encoded URL.
+        """
+        entry = self.get(encoded_url)
+        if entry is None:
+            try:
+                # Accept both the standard and the URL safe base64 alphabets
+                encoded_url = encoded_url.replace('-', '+').replace('_', '/')
+                decoded_url = base64.b64decode(encoded_url, validate=True).decode('utf-8')
+            except (ValueError, UnicodeDecodeError):
+                return None
+            if '://' not in decoded_url:
+                return None
+            entry = self.register(decoded_url)[1]
+        entry.requests += 1
+        entry.last_requested = time.time()
+        return entry
+
+
+url_registry = UrlRegistry(max_entries=hls_proxy_url_registry_size)
+
+
+async def get_playlist_id_for_url(url):
+    """
+    Return the ID of the playlist that an upstream URL belongs to, or None if it is not from a known playlist.
+    Child URLs are recorded when their parent manifest is rewritten. Anything else is looked up in the playlist streams.
+    """
+    entry = url_registry.get_by_url(url)
+    if entry is not None and entry.playlist_id_resolved:
+        return entry.playlist_id
+    playlist_id = None
+    try:
+        async with Session() as session:
+            result = await session.execute(
+                select(PlaylistStreams.playlist_id).where(PlaylistStreams.url == url).limit(1)
+            )
+            playlist_id = result.scalar_one_or_none()
+    except Exception as e:
+        proxy_logger.error("Failed to look up playlist for URL '%s': %s", url, e)
+    entry = url_registry.register(url)[1]
+    entry.playlist_id = playlist_id
+    entry.playlist_id_resolved = True
+    return playlist_id
+
+
+async def get_playlist_proxy_settings(playlist_id):
+    """
+    Return the HLS proxy settings for a playlist, falling back to the defaults for anything not configured.
+    Settings are cached for a minute to keep DB queries off the request path.
+    """
+    cached = playlist_proxy_settings.get(playlist_id)
+    if cached and cached[1] > time.time():
+        return cached[0]
+    settings = {
+        'connections':          0,
+        'prefetch_segments':    hls_proxy_prefetch_segments,
+        'prefetch_concurrency': hls_proxy_prefetch_concurrency,
+    }
+    if playlist_id is not None:
+        try:
+            async with Session() as session:
+                result = await session.execute(select(Playlist).where(Playlist.id == playlist_id))
+                playlist = result.scalar_one_or_none()
+                if playlist:
+                    settings['connections'] = playlist.connections or 0
+                    if playlist.hls_proxy_prefetch_segments is not None:
+                        settings['prefetch_segments'] = playlist.hls_proxy_prefetch_segments
+                    if playlist.hls_proxy_prefetch_concurrency is not None:
+                        settings['prefetch_concurrency'] = playlist.hls_proxy_prefetch_concurrency
+        except Exception as e:
+            proxy_logger.error("Failed to read HLS proxy settings for playlist #%s: %s", playlist_id, e)
+    playlist_proxy_settings[playlist_id] = (settings, time.time() + 60)
+    return settings
+
+
+def get_session_url(url):
+    """
+    Return the URL of the upstream session that a URL belongs to.
+    Variant playlists found in a master playlist are part of the same session as the master playlist.
+    """
+    session_url = url
+    for _ in range(5):
+        entry = url_registry.get_by_url(session_url)
+        if entry is None or entry.parent_url is None:
+            break
+        session_url = entry.parent_url
+    return session_url
+
+
+class PlaylistConnectionSlots:
+    """Tracks the upstream sessions holding connection slots for one playlist."""
 
-async def prefetch_segments(segment_urls):
-    async with aiohttp.ClientSession() as session:
-        for url in segment_urls:
-            if not await cache.exists(url):
-                proxy_logger.info("[CACHE] Saved URL '%s' to cache", url)
+    def __init__(self, playlist_id):
+        self.playlist_id = playlist_id
+        self.limit = 0
+        self.sessions = {}  # Session URL -> set of owners (pollers and streams) using it
+        self.waiting = 0
+        self.rejected = 0
+        self.condition = asyncio.Condition()
+
+
+class ConnectionSlotManager:
+    """
+    Limits the number of upstream sessions opened for each playlist to its configured connections.
+
+    A session is identified by its top level URL, so every poller and stream of the same channel (the master
+    playlist, its variants, or an FFmpeg relay of it) shares a single slot. New sessions over the limit wait for a
+    slot to be released, and are rejected if none becomes free within the timeout.
+    """
+
+    def __init__(self, wait_timeout):
+        self.wait_timeout = wait_timeout
+        self.playlists = {}
+
+    async def acquire(self, playlist_id, session_url, owner, limit, wait_timeout=None):
+        """Claim a slot for an owner of a session. Returns False if no slot became free in time."""
+        if wait_timeout is None:
+            wait_timeout = self.wait_timeout
+        if playlist_id is None:
+            return True
+        slots = self.playlists.get(playlist_id)
+        if slots is None:
+            slots = PlaylistConnectionSlots(playlist_id)
+            self.playlists[playlist_id] = slots
+        slots.limit = limit
+        async with slots.condition:
+            if session_url not in slots.sessions and slots.limit and len(slots.sessions) >= slots.limit:
+                proxy_logger.info("All %s connections for playlist #%s are in use. Waiting for a free slot for '%s'",
+                                  slots.limit, playlist_id, session_url)
+                slots.waiting += 1
                 try:
-                    async with session.get(url) as resp:
-                        if resp.status == 200:
-                            content = await resp.read()
-                            await cache.set(url, content, expiration_time=30)  # Cache for 30 seconds
-                except Exception as e:
-                    proxy_logger.error("Failed to prefetch URL '%s': %s", url, e)
+                    if wait_timeout <= 0:
+                        raise asyncio.TimeoutError
+                    await asyncio.wait_for(
+                        slots.condition.wait_for(
+                            lambda: session_url in slots.sessions or len(slots.sessions) < slots.limit
+                        ),
+                        timeout=wait_timeout,
+                    )
+                except asyncio.TimeoutError:
+                    slots.rejected += 1
+                    proxy_logger.warning("No connection slot became free for playlist #%s. Rejecting '%s'",
+                                         playlist_id, session_url)
+                    return False
+                finally:
+                    slots.waiting -= 1
+            slots.sessions.setdefault(session_url, set()).add(owner)
+        return True
+
+    async def release(self, playlist_id, session_url, owner):
+        slots = self.playlists.get(playlist_id)
+        if slots is None:
+            return
+        async with slots.condition:
+            owners = slots.sessions.get(session_url)
+            if owners is None:
+                return
+            owners.discard(owner)
+            if not owners:
+                del slots.sessions[session_url]
+                slots.condition.notify_all()
+
+    def usage(self):
+        return {
+            playlist_id: {
+                "limit":    slots.limit,
+                "in_use":   len(slots.sessions),
+                "waiting":  slots.waiting,
+                "rejected": slots.rejected,
+                "sessions": list(slots.sessions.keys()),
+            }
+            for playlist_id, slots in self.playlists.items()
+        }
+
+
+connection_slots = ConnectionSlotManager(wait_timeout=hls_proxy_slot_wait_timeout)
+
+
+async def acquire_connection_slot(url, owner, wait_timeout=None):
+    """
+    Claim a connection slot from the playlist that a URL belongs to.
+    Returns a tuple of whether the slot was acquired, the playlist ID and the session URL (needed for the release).
+    """
+    session_url = get_session_url(url)
+    playlist_id = await get_playlist_id_for_url(session_url)
+    settings = await get_playlist_proxy_settings(playlist_id)
+    acquired = await connection_slots.acquire(playlist_id, session_url, owner, settings['connections'],
+                                              wait_timeout=wait_timeout)
+    return acquired, playlist_id, session_url
+
+
+def get_prefetch_semaphore(upstream_key, limit):
+    """Return the semaphore limiting concurrent prefetches against one upstream (a playlist or host)."""
+    limit = max(1, limit)
+    semaphore, semaphore_limit = prefetch_semaphores.get(upstream_key, (None, None))
+    if semaphore is None or semaphore_limit != limit:
+        semaphore = asyncio.Semaphore(limit)
+        prefetch_semaphores[upstream_key] = (semaphore, limit)
+    return semaphore
 
 
-def generate_base64_encoded_url(url_to_encode, extension):
-    full_url_encoded = base64.b64encode(url_to_encode.encode('utf-8')).decode('utf-8')
+def generate_proxy_base_url():
     host_base_url = ''
     host_base_url_prefix = 'http'
     host_base_url_port = ''
@@ -311,25 +1947,75 @@ def generate_base64_encoded_url(url_to_encode, extension):
         host_base_url_port = f':{hls_proxy_port}'
     if hls_proxy_host_ip:
         host_base_url = f'{host_base_url_prefix}://{hls_proxy_host_ip}{host_base_url_port}{hls_proxy_prefix}/'
-    return f'{host_base_url}{full_url_encoded}.{extension}'
+    return host_base_url
 
 
-async def fetch_and_update_playlist(decoded_url):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(decoded_url) as resp:
-            if resp.status != 200:
-                return None
+def generate_channel_relay_url(base_url, channel_id):
+    """Return the URL of the channel relay (with source failover) for a channel, relative to the app's base URL."""
+    return f'{base_url}{hls_proxy_prefix.rstrip("/")}/channel/{channel_id}'
+
+
+def unwrap_proxy_url(base_url, url):
+    """Return the upstream URL behind a URL of this HLS proxy (<prefix>/<id or b64 url>.<ext>), or the URL as given."""
+    proxy_url_prefix = f'{base_url}{hls_proxy_prefix.rstrip("/")}/'
+    if not url.startswith(proxy_url_prefix):
+        return url
+    encoded_url = url[len(proxy_url_prefix):].rsplit('.', 1)[0]
+    if '/' in encoded_url:
+        # One of the relay or live routes rather than a proxied URL
+        return url
+    url_entry = url_registry.get(encoded_url)
+    if url_entry is not None:
+        return url_entry.url
+    try:
+        return base64.b64decode(encoded_url, validate=True).decode('utf-8')
+    except (ValueError, UnicodeDecodeError):
+        return url
+
+
+def generate_stream_relay_url(base_url, url):
+    """
+    Return the URL of the shared FFmpeg stream relay for an upstream URL, relative to the app's base URL.
+    URLs that already point at this proxy are unwrapped so that the relay reads from the upstream directly.
+    """
+    encoded_url = base64.b64encode(unwrap_proxy_url(base_url, url).encode('utf-8')).decode('utf-8')
+    return f'{base_url}{hls_proxy_prefix.rstrip("/")}/stream/{encoded_url}'
+
+
+def generate_live_url(base_url, url):
+    """
+    Return the URL of the shared HLS rendition (see HlsRepackager) of a stream URL, relative to the app's base URL.
+    URLs that already point at this proxy are unwrapped so that the repackager reads from the upstream directly.
+    The URL is encoded with the URL safe base64 alphabet, as it is a path segment rather than the file name.
+    """
+    encoded_url = base64.urlsafe_b64encode(unwrap_proxy_url(base_url, url).encode('utf-8')).decode('utf-8')
+    return f'{base_url}{hls_proxy_prefix.rstrip("/")}/live/{encoded_url}/index.m3u8'
+
+
+def generate_registered_url(url_to_register, extension, playlist_id=None, parent_url=None):
+    """Register an upstream URL and return the short proxy URL that references it."""
+    url_id, _ = url_registry.register(url_to_register, playlist_id=playlist_id, parent_url=parent_url)
+    return f'{generate_proxy_base_url()}{url_id}.{extension}'
+
 
-            # Get actual URL after any redirects
-            parsed_response_url = urlparse(str(resp.url))
-            response_url = f"{parsed_response_url.scheme}://{parsed_response_url.hostname}"
+async def fetch_and_update_playlist(decoded_url, playlist_id=None):
+    """
+    Fetch an upstream playlist and rewrite its child URLs to point at this proxy.
+    Returns a tuple of the rewritten playlist and the child URLs it references.
+    """
+    session = get_proxy_session()
+    async with session.get(decoded_url) as resp:
+        if resp.status != 200:
+            return None, {}
+
+        # Get actual URL after any redirects. Relative child URLs are resolved against this.
+        response_url = str(resp.url)
 
-            # Read the original playlist content
-            playlist_content = await resp.text()
+        # Read the original playlist content
+        playlist_content = await resp.text()
 
-            # Update child URLs in the playlist
-            updated_playlist = update_child_urls(playlist_content, response_url)
-            return updated_playlist
+        # Update child URLs in the playlist
+        return update_child_urls(playlist_content, response_url, playlist_id=playlist_id)
 
 
 def get_key_uri_from_ext_x_key(line):
@@ -343,16 +2029,16 @@ def get_key_uri_from_ext_x_key(line):
     return None
 
 
-def update_child_urls(playlist_content, source_url):
+def update_child_urls(playlist_content, source_url, playlist_id=None):
     proxy_logger.debug(f"Original Playlist Content:\n{playlist_content}")
 
     updated_lines = []
     lines = playlist_content.splitlines()
-    segment_urls = []
-
-    # Generate the source base URL
-    parsed_source_base_url = urlparse(source_url)
-    source_base_url = f"{parsed_source_base_url.scheme}://{parsed_source_base_url.hostname}"
+    child_urls = {
+        'segments':  [],
+        'keys':      [],
+        'playlists': [],
+    }
 
     for line in lines:
         stripped_line = line.strip()
@@ -365,9 +2051,11 @@ def update_child_urls(playlist_content, source_url):
         if line.startswith("#EXT-X-KEY"):
             key_uri = get_key_uri_from_ext_x_key(line)
             if key_uri:
-                new_key_uri = generate_base64_encoded_url(key_uri, 'key')
+                key_url = urljoin(source_url, key_uri)
+                new_key_uri = generate_registered_url(key_url, 'key', playlist_id=playlist_id,
+                                                      parent_url=source_url)
                 updated_lines.append(line.replace(key_uri, new_key_uri))
-                segment_urls.append(key_uri)
+                child_urls['keys'].append(key_url)
             else:
                 updated_lines.append(line)
             continue
@@ -379,131 +2067,608 @@ def update_child_urls(playlist_content, source_url):
         extension = 'ts'
         if stripped_line.endswith('m3u8'):
             extension = 'm3u8'
-        url_to_encode = f"{source_base_url}/{stripped_line}"
-        updated_lines.append(generate_base64_encoded_url(url_to_encode, extension))
+        url_to_encode = urljoin(source_url, stripped_line)
+        updated_lines.append(generate_registered_url(url_to_encode, extension, playlist_id=playlist_id,
+                                                     parent_url=source_url))
 
-        # Add any ts files to list of segments to pre-fetch
+        # Add any ts files to list of segments that may be pre-fetched
         if extension == 'ts':
-            segment_urls.append(url_to_encode)
-
-    # Start prefetching segments in the background
-    asyncio.create_task(prefetch_segments(segment_urls))
+            child_urls['segments'].append(url_to_encode)
+        else:
+            child_urls['playlists'].append(url_to_encode)
 
     # Join the updated lines into a single string
     modified_playlist = "\n".join(updated_lines)
     proxy_logger.debug(f"Modified Playlist Content:\n{modified_playlist}")
-    return modified_playlist
+    return modified_playlist, child_urls
+
+
+def get_playlist_tag_value(playlist_content, tag):
+    """
+    Return the value of a single-value tag (eg. '#EXT-X-TARGETDURATION') from a playlist, or None if not present.
+    """
+    for line in playlist_content.splitlines():
+        if line.startswith(f"{tag}:"):
+            return line.split(':', 1)[1].strip()
+    return None
+
+
+class ManifestPoller:
+    """
+    Polls one upstream HLS manifest on behalf of every client requesting it.
+
+    The rewritten manifest is held in memory and served to all clients. For live playlists the poll interval
+    follows #EXT-X-TARGETDURATION (half of it when the playlist did not change, as clients are expected to do).
+    Master and VOD playlists do not change, so they are only refetched at the default interval.
+    Each refresh prefetches the next few segments from the live edge (the end of a live playlist, or the start of a
+    VOD playlist) that have not already been fetched, with the count and concurrency configured on the playlist.
+    The poller stops once no client has requested the manifest for a while, cancelling any prefetches that no
+    client is waiting on.
+    """
+
+    def __init__(self, decoded_url):
+        self.decoded_url = decoded_url
+        self.playlist_id = None
+        self.content = None
+        self.prefetched_urls = set()
+        self.target_duration = None
+        self.media_sequence = None
+        self.is_live = False
+        self.last_fetched = 0
+        self.last_requested = time.time()
+        self.running = True
+        self.rejected = False
+        self.slot = None  # (playlist ID, session URL) of the connection slot held by this poller
+        self.ready = asyncio.Event()
+        self.task = None
+        self.prefetch_tasks = set()
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def prefetch(self, child_urls):
+        settings = await get_playlist_proxy_settings(self.playlist_id)
+        prefetch_count = settings['prefetch_segments']
+        segment_urls = child_urls.get('segments', [])
+        if prefetch_count <= 0:
+            window = []
+        elif self.is_live:
+            window = segment_urls[-prefetch_count:]
+        else:
+            window = segment_urls[:prefetch_count]
+        current_urls = set(segment_urls + child_urls.get('keys', []))
+        # Forget anything that has dropped out of the playlist
+        self.prefetched_urls &= current_urls
+        urls = [u for u in child_urls.get('keys', []) + window if u not in self.prefetched_urls]
+        if not urls:
+            return
+        self.prefetched_urls.update(urls)
+        # Limit concurrency per upstream provider (the playlist), or per host when the playlist is unknown
+        upstream_key = self.playlist_id if self.playlist_id is not None else urlparse(self.decoded_url).hostname
+        semaphore = get_prefetch_semaphore(upstream_key, settings['prefetch_concurrency'])
+        # Keep a reference to the task until it is done so that it is not garbage collected part way through
+        task = asyncio.create_task(prefetch_segments(urls, semaphore))
+        self.prefetch_tasks.add(task)
+        task.add_done_callback(self.prefetch_tasks.discard)
+
+    def touch(self):
+        self.last_requested = time.time()
+
+    def idle_timeout(self):
+        if self.target_duration:
+            return max(hls_proxy_manifest_idle_timeout, self.target_duration * 3)
+        return hls_proxy_manifest_idle_timeout
+
+    def poll_interval(self, changed):
+        if not self.is_live:
+            return hls_proxy_manifest_default_ttl
+        if changed:
+            return self.target_duration
+        return self.target_duration / 2
+
+    async def refresh(self):
+        """Fetch the manifest from upstream. Returns True if the playlist has changed."""
+        started = time.perf_counter()
+        metrics.inc('upstream_fetches', 'manifest')
+        url_entry = url_registry.get_by_url(self.decoded_url)
+        if url_entry is not None:
+            url_entry.upstream_fetches += 1
+        try:
+            updated_playlist, child_urls = await fetch_and_update_playlist(self.decoded_url,
+                                                                           playlist_id=self.playlist_id)
+        except Exception as e:
+            proxy_logger.error("Failed to fetch the original playlist '%s': %s", self.decoded_url, e)
+            metrics.inc('upstream_errors', 'manifest')
+            return False
+        metrics.observe('upstream_download_seconds', 'manifest', time.perf_counter() - started)
+        if updated_playlist is None:
+            proxy_logger.error("Failed to fetch the original playlist '%s'", self.decoded_url)
+            metrics.inc('upstream_errors', 'manifest')
+            return False
+        self.last_fetched = time.time()
+
+        target_duration = get_playlist_tag_value(updated_playlist, '#EXT-X-TARGETDURATION')
+        media_sequence = get_playlist_tag_value(updated_playlist, '#EXT-X-MEDIA-SEQUENCE')
+        self.target_duration = float(target_duration) if target_duration else None
+        self.is_live = bool(self.target_duration) and '#EXT-X-ENDLIST' not in updated_playlist
+        changed = updated_playlist != self.content or media_sequence != self.media_sequence
+        self.media_sequence = media_sequence
+
+        if changed:
+            self.content = updated_playlist
+            await self.prefetch(child_urls)
+        return changed
+
+    async def run(self):
+        try:
+            self.playlist_id = await get_playlist_id_for_url(self.decoded_url)
+            # Wait for a free connection slot on the playlist before polling upstream
+            acquired, playlist_id, session_url = await acquire_connection_slot(self.decoded_url, self)
+            if not acquired:
+                self.rejected = True
+                return
+            self.slot = (playlist_id, session_url)
+            while self.running:
+                changed = await self.refresh()
+                self.ready.set()
+                if self.content is None:
+                    # Nothing to serve. Let the next client request start a new poller.
+                    break
+                await asyncio.sleep(self.poll_interval(changed))
+                if time.time() - self.last_requested > self.idle_timeout():
+                    proxy_logger.info("No clients have requested m3u8 URL '%s' recently, stopping poller",
+                                      self.decoded_url)
+                    break
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.running = False
+            self.ready.set()
+            for task in list(self.prefetch_tasks):
+                task.cancel()
+            if manifest_pollers.get(self.decoded_url) is self:
+                del manifest_pollers[self.decoded_url]
+            if self.slot is not None:
+                await connection_slots.release(*self.slot, self)
+                self.slot = None
+
+    async def get_content(self):
+        self.touch()
+        await self.ready.wait()
+        return self.content
 
 
 @blueprint.route(f'{hls_proxy_prefix.lstrip("/")}/<encoded_url>.m3u8', methods=['GET'])
 async def proxy_m3u8(encoded_url):
-    # Decode the Base64 encoded URL
-    decoded_url = base64.b64decode(encoded_url).decode('utf-8')
-
-    updated_playlist = await fetch_and_update_playlist(decoded_url)
+    # Resolve the registered URL ID (or Base64 encoded URL)
+    url_entry = url_registry.resolve(encoded_url)
+    if url_entry is None:
+        return Response("Unknown proxy URL.", status=404)
+    decoded_url = url_entry.url
+
+    # Serve the manifest from the shared poller for this URL, starting one if needed
+    poller = manifest_pollers.get(decoded_url)
+    if poller is None or not poller.running:
+        proxy_logger.info("[MISS] Serving m3u8 URL '%s' without cache", decoded_url)
+        metrics.inc('cache_misses', 'm3u8')
+        url_entry.misses += 1
+        poller = ManifestPoller(decoded_url)
+        manifest_pollers[decoded_url] = poller
+        poller.start()
+    else:
+        proxy_logger.info("[HIT] Serving m3u8 URL from cache: %s", decoded_url)
+        metrics.inc('cache_hits', 'm3u8')
+        metrics.inc('cache_tier_hits', 'manifest_poller')
+        url_entry.hits += 1
+
+    metrics.inc('requests', 'm3u8')
+    updated_playlist = await poller.get_content()
+    if poller.rejected:
+        metrics.inc('rejected', 'm3u8')
+        return Response("All upstream connections for this playlist are in use.", status=503,
+                        headers={'Retry-After': str(int(hls_proxy_slot_wait_timeout))})
     if updated_playlist is None:
         proxy_logger.error("Failed to fetch the original playlist '%s'", decoded_url)
         return Response("Failed to fetch the original playlist.", status=404)
+    metrics.inc('bytes_served', 'm3u8', len(updated_playlist))
+    url_entry.bytes_served += len(updated_playlist)
 
-    proxy_logger.info(f"[MISS] Serving m3u8 URL '%s' without cache", decoded_url)
     return Response(updated_playlist, content_type='application/vnd.apple.mpegurl')
 
 
 @blueprint.route(f'{hls_proxy_prefix.lstrip("/")}/<encoded_url>.key', methods=['GET'])
 async def proxy_key(encoded_url):
-    # Decode the Base64 encoded URL
-    decoded_url = base64.b64decode(encoded_url).decode('utf-8')
-
-    # Check if the .key file is already cached
-    if await cache.exists(decoded_url):
-        proxy_logger.info(f"[HIT] Serving key URL from cache: %s", decoded_url)
-        cached_content = await cache.get(decoded_url)
-        return Response(cached_content, content_type='application/octet-stream')
-
-    # If not cached, fetch the file and cache it
-    proxy_logger.info(f"[MISS] Serving key URL '%s' without cache", decoded_url)
-    async with aiohttp.ClientSession() as session:
-        async with session.get(decoded_url) as resp:
-            if resp.status != 200:
-                proxy_logger.error("Failed to fetch key file '%s'", decoded_url)
-                return Response("Failed to fetch the file.", status=404)
-            content = await resp.read()
-            await cache.set(decoded_url, content, expiration_time=30)  # Cache for 30 seconds
-            return Response(content, content_type='application/octet-stream')
+    # Resolve the registered URL ID (or Base64 encoded URL)
+    url_entry = url_registry.resolve(encoded_url)
+    if url_entry is None:
+        return Response("Unknown proxy URL.", status=404)
+    decoded_url = url_entry.url
+
+    # Serve the .key file from the cache or a single shared upstream fetch
+    return await serve_with_cache(decoded_url, 'key', 'application/octet-stream')
 
 
 @blueprint.route(f'{hls_proxy_prefix.lstrip("/")}/<encoded_url>.ts', methods=['GET'])
 async def proxy_ts(encoded_url):
-    # Decode the Base64 encoded URL
-    decoded_url = base64.b64decode(encoded_url).decode('utf-8')
-
-    # Check if the .ts file is already cached
-    if await cache.exists(decoded_url):
-        proxy_logger.info(f"[HIT] Serving ts URL from cache: %s", decoded_url)
-        cached_content = await cache.get(decoded_url)
-        return Response(cached_content, content_type='video/mp2t')
-
-    # If not cached, fetch the file and cache it
-    proxy_logger.info(f"[MISS] Serving ts URL '%s' without cache", decoded_url)
-    async with aiohttp.ClientSession() as session:
-        async with session.get(decoded_url) as resp:
-            if resp.status != 200:
-                proxy_logger.error("Failed to fetch ts file '%s'", decoded_url)
-                return Response("Failed to fetch the file.", status=404)
-            content = await resp.read()
-            await cache.set(decoded_url, content, expiration_time=30)  # Cache for 30 seconds
-            return Response(content, content_type='video/mp2t')
+    # Resolve the registered URL ID (or Base64 encoded URL)
+    url_entry = url_registry.resolve(encoded_url)
+    if url_entry is None:
+        return Response("Unknown proxy URL.", status=404)
+    decoded_url = url_entry.url
+
+    # Serve the .ts file from the cache or a single shared upstream fetch
+    return await serve_with_cache(decoded_url, 'ts', 'video/mp2t')
 
 
 @blueprint.route(f'{hls_proxy_prefix.lstrip("/")}/stream/<encoded_url>', methods=['GET'])
 async def stream_ts(encoded_url):
-    # Decode the Base64 encoded URL
-    decoded_url = base64.b64decode(encoded_url).decode('utf-8')
+    # Resolve the registered URL ID (or Base64 encoded URL)
+    url_entry = url_registry.resolve(encoded_url)
+    if url_entry is None:
+        return Response("Unknown proxy URL.", status=404)
+    decoded_url = url_entry.url
 
     # Generate a unique identifier (UUID) for the connection
     connection_id = str(uuid.uuid4())  # Use a UUID for the connection ID
 
-    # Check if the stream is active and has connections
-    if decoded_url not in active_streams or not active_streams[decoded_url].running or active_streams[
-        decoded_url].connection_count == 0:
+    # Check if the stream is active (including one lingering after its last connection closed)
+    if decoded_url not in active_streams or not active_streams[decoded_url].running:
         buffer_logger.info("Creating new FFmpeg stream with connection ID %s.", connection_id)
-        # Create a new stream if it does not exist or if there are no connections
+        # Create a new stream if it does not exist or has stopped
         stream = FFmpegStream(decoded_url)
+        stream.start()
         active_streams[decoded_url] = stream
     else:
         buffer_logger.info("Connecting to existing FFmpeg stream with connection ID %s.", connection_id)
 
-    # Get the existing stream
-    stream = active_streams[decoded_url]
+    return await serve_stream(active_streams[decoded_url], connection_id, source_url=decoded_url)
+
+
+async def get_channel_source_urls(channel_id):
+    """Return the upstream URLs of a channel's sources from enabled playlists, highest priority first."""
+    async with Session() as session:
+        result = await session.execute(
+            select(ChannelSource, PlaylistStreams.url)
+            .join(Playlist, Playlist.id == ChannelSource.playlist_id)
+            .outerjoin(PlaylistStreams, and_(PlaylistStreams.playlist_id == ChannelSource.playlist_id,
+                                             PlaylistStreams.name == ChannelSource.playlist_stream_name))
+            .where(ChannelSource.channel_id == channel_id, Playlist.enabled == True)
+        )
+        rows = result.all()
+
+    def source_priority(row):
+        try:
+            return int(row[0].priority or 0)
+        except ValueError:
+            return 0
+
+    source_urls = []
+    for channel_source, stream_url in sorted(rows, key=source_priority, reverse=True):
+        # Prefer the original stream URL over the (possibly proxied) URL that was published to TVHeadend
+        url = stream_url or channel_source.playlist_stream_url
+        if url and url not in source_urls:
+            source_urls.append(url)
+    return source_urls
+
+
+@blueprint.route(f'{hls_proxy_prefix.lstrip("/")}/channel/<int:channel_id>', methods=['GET'])
+async def stream_channel(channel_id):
+    stream_key = f'channel:{channel_id}'
+    connection_id = str(uuid.uuid4())
+
+    stream = active_streams.get(stream_key)
+    if stream is None or not stream.running:
+        source_urls = await get_channel_source_urls(channel_id)
+        if not source_urls:
+            return Response("Channel has no sources.", status=404)
+        # Another connection may have started the relay while the sources were being read
+        stream = active_streams.get(stream_key)
+        if stream is None or not stream.running:
+            buffer_logger.info("Creating new relay for channel #%s with connection ID %s.", channel_id, connection_id)
+            stream = ChannelStream(channel_id, source_urls)
+            stream.start()
+            active_streams[stream_key] = stream
+    else:
+        buffer_logger.info("Connecting to existing relay for channel #%s with connection ID %s.", channel_id,
+                           connection_id)
+
+    return await serve_stream(stream, connection_id)
+
+
+def get_hls_repackager(decoded_url):
+    """Return the running repackager for an upstream URL, starting one if needed."""
+    repackager = hls_repackagers.get(decoded_url)
+    if repackager is None or not repackager.running:
+        proxy_logger.info("Starting HLS repackaging of '%s'", decoded_url)
+        repackager = HlsRepackager(decoded_url)
+        hls_repackagers[decoded_url] = repackager
+        repackager.start()
+    repackager.touch()
+    return repackager
+
+
+@blueprint.route(f'{hls_proxy_prefix.lstrip("/")}/live/<encoded_url>/index.m3u8', methods=['GET'])
+async def proxy_live_m3u8(encoded_url):
+    url_entry = url_registry.resolve(encoded_url)
+    if url_entry is None:
+        return Response("Unknown proxy URL.", status=404)
+    repackager = get_hls_repackager(url_entry.url)
+
+    await repackager.slot_ready.wait()
+    if repackager.rejected:
+        return Response("All upstream connections for this playlist are in use.", status=503,
+                        headers={'Retry-After': str(int(hls_proxy_slot_wait_timeout))})
+    # The first manifest is written once the first segment is complete
+    if not await repackager.wait_for_manifest(timeout=hls_proxy_failover_start_timeout +
+                                                      hls_proxy_repackage_segment_duration * 3):
+        return Response("Failed to repackage the stream.", status=404)
+    manifest = await repackager.read_file('index.m3u8')
+    if manifest is None:
+        return Response("Failed to repackage the stream.", status=404)
+    response = Response(manifest, content_type='application/vnd.apple.mpegurl')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@blueprint.route(f'{hls_proxy_prefix.lstrip("/")}/live/<encoded_url>/<segment_name>.ts', methods=['GET'])
+async def proxy_live_ts(encoded_url, segment_name):
+    url_entry = url_registry.resolve(encoded_url)
+    repackager = hls_repackagers.get(url_entry.url) if url_entry is not None else None
+    if repackager is None or not segment_name.startswith('seg') or not segment_name[3:].isdigit():
+        return Response("Segment not found.", status=404)
+    repackager.touch()
+    segment = await repackager.read_file(f'{segment_name}.ts')
+    if segment is None:
+        return Response("Segment not found.", status=404)
+    return Response(segment, content_type='video/mp2t')
+
+
+async def serve_stream(stream, connection_id, source_url=None):
     stream.last_activity = time.time()  # Update last activity time
 
-    # Add a new buffer for this connection
-    stream.add_buffer(connection_id)
+    # Add a new reader for this connection
+    reader = stream.add_reader(connection_id)
+    reader.source_url = source_url
+
+    metrics.inc('requests', 'stream')
 
-    # Create a generator to stream data from the connection-specific buffer
+    # Wait until the stream has a connection slot on its playlist
+    await stream.slot_ready.wait()
+    if stream.rejected:
+        stream.remove_reader(connection_id)
+        metrics.inc('rejected', 'stream')
+        return Response("All upstream connections for this playlist are in use.", status=503,
+                        headers={'Retry-After': str(int(hls_proxy_slot_wait_timeout))})
+
+    # Create a generator to stream data from the shared buffer using the connection-specific reader
     @stream_with_context
     async def generate():
         try:
             while True:
-                # Check if the buffer exists before reading
-                if connection_id in stream.buffers:
-                    data = stream.buffers[connection_id].read()
+                # Check if the reader exists before reading
+                if connection_id in stream.readers:
+                    data = stream.buffer.read(reader)
                     if data:
+                        reader.bytes_sent += len(data)
+                        metrics.inc('bytes_served', 'stream', len(data))
                         yield data
+                    elif reader.disconnected:
+                        buffer_logger.info("Closing disconnected connection %s.", connection_id)
+                        break
                     else:
                         # Check if FFmpeg is still running
                         if not stream.running:
                             buffer_logger.info("FFmpeg has stopped, closing stream.")
                             break
-                        # Sleep briefly if no data is available
-                        await asyncio.sleep(0.1)  # Wait before checking again
+                        # Wait to be woken by the next chunk written by FFmpeg
+                        await stream.buffer.wait_for_data(reader)
                 else:
-                    # If the buffer doesn't exist, break the loop
+                    # If the reader doesn't exist, break the loop
                     break
         finally:
-            stream.remove_buffer(connection_id)  # Remove the buffer on connection close
+            stream.remove_reader(connection_id)  # Remove the reader on connection close
 
     # Create a response object with the correct content type and set timeout to None
     response = Response(generate(), content_type='video/mp2t')
     response.timeout = None  # Disable timeout for streaming response
     return response
+
+
+@blueprint.route('/tic-api/hls-proxy/connections', methods=['GET'])
+@admin_auth_required
+async def api_get_hls_proxy_connections():
+    return jsonify(
+        {
+            "success": True,
+            "data":    connection_slots.usage(),
+        }
+    ), 200
+
+
+def get_running_streams():
+    """Return the active streams keyed by the key they were started under, skipping the aliases of channel streams."""
+    streams = {}
+    for key, stream in list(active_streams.items()):
+        if not any(existing is stream for existing in streams.values()):
+            streams[key] = stream
+    return streams
+
+
+def get_url_metrics(limit=20):
+    """
+    Return the per-URL counters aggregated by upstream session (the top level manifest or stream URL),
+    ordered by bytes served.
+    """
+    sessions = {}
+    for entry in list(url_registry.entries.values()):
+        if not (entry.requests or entry.upstream_fetches):
+            continue
+        session_url = get_session_url(entry.url)
+        session = sessions.setdefault(session_url, {
+            "url":              session_url,
+            "playlist_id":      None,
+            "urls":             0,
+            "requests":         0,
+            "hits":             0,
+            "misses":           0,
+            "bytes_served":     0,
+            "upstream_fetches": 0,
+            "last_requested":   None,
+        })
+        session["urls"] += 1
+        session["requests"] += entry.requests
+        session["hits"] += entry.hits
+        session["misses"] += entry.misses
+        session["bytes_served"] += entry.bytes_served
+        session["upstream_fetches"] += entry.upstream_fetches
+        if entry.playlist_id is not None:
+            session["playlist_id"] = entry.playlist_id
+        if entry.last_requested and (session["last_requested"] or 0) < entry.last_requested:
+            session["last_requested"] = entry.last_requested
+    ordered = sorted(sessions.values(), key=lambda s: s["bytes_served"], reverse=True)
+    return ordered[:limit]
+
+
+def get_proxy_metrics(url_limit=20):
+    counters = {}
+    for (name, label), value in metrics.counters.items():
+        counters.setdefault(name, {})[label] = value
+    histograms = {}
+    for (name, label), histogram in metrics.histograms.items():
+        histograms.setdefault(name, {})[label] = histogram.snapshot()
+    return {
+        "uptime":             int(time.time() - metrics.started_at),
+        "counters":           counters,
+        "histograms":         histograms,
+        "streams":            {key: stream.stats() for key, stream in get_running_streams().items()},
+        "repackagers":        {url: repackager.stats() for url, repackager in list(hls_repackagers.items())},
+        "manifest_pollers":   len(manifest_pollers),
+        "inflight_downloads": len(inflight_downloads),
+        "registered_urls":    len(url_registry.entries),
+        "cache":              cache.stats(),
+        "disk_cache":         disk_cache.stats(),
+        "connections":        connection_slots.usage(),
+        "urls":               get_url_metrics(url_limit),
+    }
+
+
+def _prometheus_labels(**labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def render_prometheus_metrics(url_limit=20):
+    """Render the proxy metrics in the Prometheus text exposition format."""
+    lines = []
+
+    def metric(name, metric_type, help_text, samples):
+        lines.append(f'# HELP tic_hls_proxy_{name} {help_text}')
+        lines.append(f'# TYPE tic_hls_proxy_{name} {metric_type}')
+        for suffix, labels, value in samples:
+            lines.append(f'tic_hls_proxy_{name}{suffix}{_prometheus_labels(**labels) if labels else ""} {value}')
+
+    counter_help = {
+        'requests':         'Client requests by resource type.',
+        'rejected':         'Client requests rejected because the playlist had no free connection slots.',
+        'cache_hits':       'Requests served without a new upstream fetch, by resource type.',
+        'cache_tier_hits':  'Cache hits by the cache tier that served them.',
+        'cache_misses':     'Requests that had to be fetched from upstream, by resource type.',
+        'bytes_served':     'Bytes sent to clients by resource type.',
+        'upstream_fetches': 'Requests made to upstream servers.',
+        'upstream_errors':  'Failed requests to upstream servers.',
+        'upstream_bytes':   'Bytes downloaded from upstream servers.',
+        'stream_stalls':    'FFmpeg streams stopped because their input stalled.',
+    }
+    counter_names = sorted({name for name, _ in metrics.counters})
+    for name in counter_names:
+        metric(f'{name}_total', 'counter', counter_help.get(name, name.replace('_', ' ').capitalize() + '.'),
+               [('', {'kind': label}, value) for (n, label), value in sorted(metrics.counters.items()) if n == name])
+
+    histogram_help = {
+        'upstream_response_seconds': 'Time until upstream response headers were received.',
+        'upstream_download_seconds': 'Time to download a complete upstream response.',
+    }
+    for name in sorted({name for name, _ in metrics.histograms}):
+        samples = []
+        for (n, label), histogram in sorted(metrics.histograms.items()):
+            if n != name:
+                continue
+            for bound, count in histogram.cumulative_counts():
+                samples.append(('_bucket', {'kind': label, 'le': '+Inf' if bound == float('inf') else bound}, count))
+            samples.append(('_sum', {'kind': label}, round(histogram.sum, 6)))
+            samples.append(('_count', {'kind': label}, histogram.count))
+        metric(name, 'histogram', histogram_help.get(name, name.replace('_', ' ').capitalize() + '.'), samples)
+
+    streams = list(get_running_streams().values())
+    metric('active_streams', 'gauge', 'Running FFmpeg streams.', [('', None, len(streams))])
+    metric('stream_readers', 'gauge', 'Clients connected to FFmpeg streams.',
+           [('', None, sum(len(stream.readers) for stream in streams))])
+    metric('stream_slow_reader_drops_total', 'counter',
+           'Times a client fell too far behind a stream and skipped ahead or was disconnected.',
+           [('', None, sum(stream.buffer.slow_reader_drops for stream in streams))])
+    # Per stream series from FFmpeg's progress reports. Streams are bounded by the playlist connection limits.
+    running_streams = list(get_running_streams().items()) + list(hls_repackagers.items())
+    metric('stream_bitrate_bps', 'gauge', 'Input bitrate reported by FFmpeg, in bits/s.',
+           [('', {'stream': key}, stream.progress.bitrate) for key, stream in running_streams
+            if stream.progress.bitrate is not None])
+    metric('stream_speed', 'gauge', 'Processing speed reported by FFmpeg, relative to real time.',
+           [('', {'stream': key}, stream.progress.speed) for key, stream in running_streams
+            if stream.progress.speed is not None])
+    metric('stream_drop_frames_total', 'counter', 'Frames dropped by FFmpeg.',
+           [('', {'stream': key}, stream.progress.drop_frames) for key, stream in running_streams])
+    metric('stream_seconds_since_last_input', 'gauge', 'Seconds since FFmpeg last received input.',
+           [('', {'stream': key}, round(time.time() - stream.last_input_at(), 3)) for key, stream in running_streams
+            if stream.last_input_at() is not None])
+    metric('repackagers', 'gauge', 'Running HLS repackagers.', [('', None, len(hls_repackagers))])
+    metric('manifest_pollers', 'gauge', 'Manifests being polled from upstream.', [('', None, len(manifest_pollers))])
+    metric('inflight_downloads', 'gauge', 'Upstream downloads in progress.', [('', None, len(inflight_downloads))])
+
+    for tier, tier_stats in (('memory', cache.stats()), ('disk', disk_cache.stats())):
+        metric(f'cache_{tier}_bytes', 'gauge', f'Bytes held in the {tier} segment cache.',
+               [('', None, tier_stats['size'])])
+        metric(f'cache_{tier}_entries', 'gauge', f'Entries held in the {tier} segment cache.',
+               [('', None, tier_stats['entries'])])
+        metric(f'cache_{tier}_evictions_total', 'counter', f'Entries evicted from the {tier} segment cache.',
+               [('', None, tier_stats['evictions'])])
+
+    usage = connection_slots.usage()
+    metric('connection_slots_in_use', 'gauge', 'Upstream connection slots in use by playlist.',
+           [('', {'playlist_id': playlist_id}, slots['in_use']) for playlist_id, slots in usage.items()])
+    metric('connection_slots_limit', 'gauge', 'Upstream connection limit by playlist (0 is unlimited).',
+           [('', {'playlist_id': playlist_id}, slots['limit'] or 0) for playlist_id, slots in usage.items()])
+    metric('connection_slots_rejected_total', 'counter', 'Upstream sessions refused a connection slot by playlist.',
+           [('', {'playlist_id': playlist_id}, slots['rejected']) for playlist_id, slots in usage.items()])
+
+    # Per URL series are aggregated by upstream session and limited to the busiest ones to bound label cardinality
+    sessions = get_url_metrics(url_limit)
+    for field, help_text in (('requests', 'Client requests by upstream session.'),
+                             ('hits', 'Cache hits by upstream session.'),
+                             ('misses', 'Cache misses by upstream session.'),
+                             ('bytes_served', 'Bytes sent to clients by upstream session.'),
+                             ('upstream_fetches', 'Upstream requests by upstream session.')):
+        metric(f'session_{field}_total', 'counter', help_text,
+               [('', {'url': session['url']}, session[field]) for session in sessions])
+
+    return '\n'.join(lines) + '\n'
+
+
+@blueprint.route('/tic-api/hls-proxy/metrics', methods=['GET'])
+@admin_auth_required
+async def api_get_hls_proxy_metrics():
+    url_limit = request.args.get('urls', default=20, type=int)
+    return jsonify(
+        {
+            "success": True,
+            "data":    get_proxy_metrics(url_limit=url_limit),
+        }
+    ), 200
+
+
+@blueprint.route('/tic-api/hls-proxy/metrics/prometheus', methods=['GET'])
+@admin_auth_required
+async def api_get_hls_proxy_prometheus_metrics():
+    url_limit = request.args.get('urls', default=20, type=int)
+    return Response(render_prometheus_metrics(url_limit=url_limit),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -57,16 +57,29 @@ async def _get_tvh_settings(include_auth=True, stream_profile='pass'):
     # Set stream configuration
     stream_priority = 300
     return {
-        "tic_base_url":    tic_base_url,
-        "tvh_base_url":    tvh_base_url,
-        "tvh_path":        tvh_path,
-        "tvh_api_url":     tvh_api_url,
-        "tvh_http_url":    tvh_http_url,
-        "stream_profile":  stream_profile,
-        "stream_priority": stream_priority,
+        "tic_base_url":       tic_base_url,
+        "tvh_base_url":       tvh_base_url,
+        "tvh_path":           tvh_path,
+        "tvh_api_url":        tvh_api_url,
+        "tvh_http_url":       tvh_http_url,
+        "stream_profile":     stream_profile,
+        "stream_priority":    stream_priority,
+        "hdhr_direct_stream": settings['settings']['hdhr_direct_stream'],
     }
 
 
+def _get_channel_stream_url(channel_details, tvh_settings):
+    if tvh_settings['hdhr_direct_stream']:
+        # Stream the channel from this application's relay, failing over between the channel's sources
+        from backend.api.routes_hls_proxy import generate_channel_relay_url
+        return generate_channel_relay_url(tvh_settings["tic_base_url"], channel_details["id"])
+    if channel_details.get('tvh_uuid'):
+        channel_url = f'{tvh_settings["tvh_http_url"]}/stream/channel/{channel_details["tvh_uuid"]}'
+        path_args = f'?profile={tvh_settings["stream_profile"]}&weight={tvh_settings["stream_priority"]}'
+        return f'{channel_url}{path_args}'
+    return None
+
+
 async def _get_channels(playlist_id):
     return_channels = []
     from backend.channels import read_config_all_channels
@@ -111,17 +124,13 @@ async def _get_discover_data(playlist_id=0):
 
 
 async def _get_lineup_list(playlist_id):
-    use_tvh_source = True
     tvh_settings = await _get_tvh_settings(include_auth=True)
     lineup_list = []
     from backend.epgs import generate_epg_channel_id
     for channel_details in await _get_channels(playlist_id):
         channel_id = generate_epg_channel_id(channel_details["number"], channel_details["name"])
-        # TODO: Add support for fetching a stream from this application without using TVH as a proxy
-        if use_tvh_source and channel_details.get('tvh_uuid'):
-            channel_url = f'{tvh_settings["tvh_http_url"]}/stream/channel/{channel_details["tvh_uuid"]}'
-            path_args = f'?profile={tvh_settings["stream_profile"]}&weight={tvh_settings["stream_priority"]}'
-            url = f'{channel_url}{path_args}'
+        url = _get_channel_stream_url(channel_details, tvh_settings)
+        if url:
             lineup_list.append(
                 {
                     'GuideNumber': channel_id,
@@ -132,8 +141,7 @@ async def _get_lineup_list(playlist_id):
     return lineup_list
 
 
-async def _get_playlist_channels(playlist_id, include_auth=False, stream_profile='pass'):
-    use_tvh_source = True
+async def _get_playlist_channels(playlist_id, include_auth=False, stream_profile='pass', hls=False):
     tvh_settings = await _get_tvh_settings(include_auth=include_auth, stream_profile=stream_profile)
     playlist = [f'#EXTM3U url-tvg="{tvh_settings["tic_base_url"]}/tic-web/epg.xml"']
     from backend.epgs import generate_epg_channel_id
@@ -148,11 +156,12 @@ async def _get_playlist_channels(playlist_id, include_auth=False, stream_profile
             group_title = channel_details['tags'][0]
             line += f' group-title="{group_title}"'
         playlist.append(line)
-        # TODO: Add support for fetching a stream from this application without using TVH as a proxy
-        if use_tvh_source and channel_details.get('tvh_uuid'):
-            channel_url = f'{tvh_settings["tvh_http_url"]}/stream/channel/{channel_details["tvh_uuid"]}'
-            path_args = f'?profile={tvh_settings["stream_profile"]}&weight={tvh_settings["stream_priority"]}'
-            url = f'{channel_url}{path_args}'
+        url = _get_channel_stream_url(channel_details, tvh_settings)
+        if url:
+            if hls:
+                # Serve the channel as a live HLS rendition that this application repackages once for all clients
+                from backend.api.routes_hls_proxy import generate_live_url
+                url = generate_live_url(tvh_settings["tic_base_url"], url)
             playlist.append(url)
     return playlist
 
@@ -198,9 +207,12 @@ async def tvh_playlist_m3u(playlist_id):
     # Check for 'include_auth' GET argument
     include_auth = request.args.get('include_auth') != 'false'
     stream_profile = request.args.get('profile', 'pass')
+    # Check for the 'format' GET argument. HLS clients can request 'hls' to get HLS renditions of the channels.
+    hls = request.args.get('format') == 'hls'
 
     # Get the playlist channels
-    file_lines = await _get_playlist_channels(playlist_id, include_auth=include_auth, stream_profile=stream_profile)
+    file_lines = await _get_playlist_channels(playlist_id, include_auth=include_auth, stream_profile=stream_profile,
+                                              hls=hls)
     # Join the lines to form the m3u content
     m3u_content = "\n".join(file_lines)
     # Create a response object with appropriate headers
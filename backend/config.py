@@ -154,6 +154,8 @@ class Config:
                                             "-probesize 10M -analyzeduration 0 -fpsprobesize 0 "
                                             "-i [URL] -c copy -metadata service_name=[SERVICE_NAME] "
                                             "-f mpegts pipe:1",
+                "use_tic_stream_relay":     False,
+                "hdhr_direct_stream":       False,
                 "create_client_user":       True,
                 "client_username":          "client",
                 "client_password":          "client",
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+
+import aiofiles
+import aiohttp
+
+from backend.config import read_yaml, write_yaml
+
+logger = logging.getLogger('tic.downloads')
+
+# Limits on the number of playlist and EPG sources downloaded at once, in total and from any one host
+source_download_concurrency = int(os.environ.get('SOURCE_DOWNLOAD_CONCURRENCY', 4))
+source_download_concurrency_per_host = int(os.environ.get('SOURCE_DOWNLOAD_CONCURRENCY_PER_HOST', 2))
+
+# Number of worker processes that parse downloaded sources. Set to 0 to parse in the main process.
+source_parse_workers = int(os.environ.get('SOURCE_PARSE_WORKERS', min(4, os.cpu_count() or 1)))
+
+source_download_semaphore = asyncio.Semaphore(source_download_concurrency)
+source_host_semaphores = {}
+parse_pool = None
+
+
+@asynccontextmanager
+async def source_download_slot(url):
+    """Wait for a free download slot, both overall and for the URL's host."""
+    host = urlparse(url).hostname or ''
+    host_semaphore = source_host_semaphores.get(host)
+    if host_semaphore is None:
+        host_semaphore = source_host_semaphores[host] = asyncio.Semaphore(source_download_concurrency_per_host)
+    async with host_semaphore:
+        async with source_download_semaphore:
+            yield
+
+
+def _parse_pool_context():
+    """
+    Workers are not forked from this multithreaded process. Where available they are forked from a fork server
+    that has already imported the parsers (see source_parsers.py), so starting a worker is cheap.
+    Workers still import the main script as '__mp_main__', so it must not import the app when imported that way
+    (see run.py).
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['source_parsers'])
+    return context
+
+
+async def run_in_parse_pool(func, *args):
+    """
+    Run a parsing function in the worker process pool, keeping CPU heavy parsing off the event loop (which also
+    serves the HLS proxy) and letting sources be parsed in parallel.
+    The function and its arguments and result must be picklable.
+    """
+    global parse_pool
+    if source_parse_workers <= 0:
+        return func(*args)
+    if parse_pool is None:
+        parse_pool = ProcessPoolExecutor(max_workers=source_parse_workers, mp_context=_parse_pool_context())
+    try:
+        return await asyncio.get_running_loop().run_in_executor(parse_pool, func, *args)
+    except BrokenProcessPool:
+        # A worker died. Start a new pool for the next call.
+        parse_pool = None
+        raise
+
+
+def read_download_metadata(metadata_file):
+    """Read the metadata recorded for a cached source file. Returns an empty dict if there is none."""
+    return read_yaml(metadata_file) or {}
+
+
+def save_download_metadata(metadata_file, metadata):
+    """
+    Record the metadata of a downloaded source file once it has been imported.
+    Any partial download state is left in place for the next download.
+    """
+    data = read_download_metadata(metadata_file)
+    data.update(metadata)
+    write_yaml(metadata_file, data)
+
+
+def _save_partial_download(metadata_file, partial):
+    data = read_download_metadata(metadata_file)
+    if partial is None:
+        data.pop('partial', None)
+    else:
+        data['partial'] = partial
+    write_yaml(metadata_file, data)
+
+
+async def download_source_file(url, output, metadata_file, headers=None, on_chunk=None):
+    """
+    Download a playlist or EPG source to its cache file, only if it has changed since it was last imported.
+
+    The request is conditional on the ETag and Last-Modified recorded in the metadata file. When the server says the
+    file is unchanged, or the downloaded content has the same hash as the last import, None is returned and the
+    cache file is left as it was. Otherwise the cache file is replaced and the new metadata is returned. The caller
+    saves it with save_download_metadata() once the file has been imported, so a failed import is retried next time.
+
+    The download is written to a .part file. If a previous download was interrupted and the server supports range
+    requests with a validator, it resumes from where it stopped.
+    If given, the on_chunk coroutine is awaited with each chunk of the file, in order from the start, as it arrives.
+    """
+    if not os.path.exists(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    metadata = read_download_metadata(metadata_file)
+    request_headers = dict(headers or {})
+    if metadata.get('url') == url and os.path.exists(output):
+        if metadata.get('etag'):
+            request_headers['If-None-Match'] = metadata['etag']
+        if metadata.get('last_modified'):
+            request_headers['If-Modified-Since'] = metadata['last_modified']
+    download_file = f"{output}.part"
+    partial = metadata.get('partial') or {}
+    resume_from = 0
+    if partial.get('url') == url and os.path.exists(download_file):
+        validator = partial.get('etag') or partial.get('last_modified')
+        # Weak ETags cannot be used to resume
+        if validator and not validator.startswith('W/'):
+            resume_from = os.path.getsize(download_file)
+            if resume_from:
+                request_headers['Range'] = f"bytes={resume_from}-"
+                request_headers['If-Range'] = validator
+
+    content_hash = hashlib.sha256()
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url, headers=request_headers) as response:
+            if response.status == 304:
+                logger.info("Source at url '%s' has not changed since it was last downloaded", url)
+                return None
+            response.raise_for_status()
+            new_metadata = {
+                'url':           url,
+                'etag':          response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+            if response.status == 206 and resume_from:
+                logger.info("Resuming download of url '%s' from %s bytes", url, resume_from)
+                mode = 'ab'
+                # Hash (and pass on) what was already downloaded before continuing with the rest
+                async with aiofiles.open(download_file, 'rb') as f:
+                    while chunk := await f.read(65536):
+                        content_hash.update(chunk)
+                        if on_chunk is not None:
+                            await on_chunk(chunk)
+            else:
+                mode = 'wb'
+            _save_partial_download(metadata_file, {
+                'url':           url,
+                'etag':          new_metadata['etag'],
+                'last_modified': new_metadata['last_modified'],
+            })
+            async with aiofiles.open(download_file, mode) as f:
+                async for chunk in response.content.iter_chunked(65536):
+                    await f.write(chunk)
+                    content_hash.update(chunk)
+                    if on_chunk is not None:
+                        await on_chunk(chunk)
+    _save_partial_download(metadata_file, None)
+    new_metadata['sha256'] = content_hash.hexdigest()
+    new_metadata['size'] = os.path.getsize(download_file)
+    new_metadata['downloaded'] = int(time.time())
+    if new_metadata['sha256'] == metadata.get('sha256') and os.path.exists(output):
+        logger.info("Source at url '%s' has the same content as when it was last downloaded", url)
+        os.remove(download_file)
+        # Keep the new validators so that the next request can be conditional
+        save_download_metadata(metadata_file, new_metadata)
+        return None
+    os.replace(download_file, output)
+    return new_metadata
@@ -9,7 +9,6 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 from mimetypes import guess_extension
 from urllib.parse import quote
 
-import aiofiles
 import aiohttp
 import asyncio
 import time
@@ -17,12 +16,13 @@ import xml.etree.ElementTree as ET
 from types import NoneType
 
 from bs4 import BeautifulSoup
-from quart.utils import run_sync
 from sqlalchemy.orm import joinedload
 from sqlalchemy import and_, delete, insert, select
 from backend.channels import read_base46_image_string
-from backend.models import db, Session, Epg, Channel, EpgChannels, EpgChannelProgrammes
+from backend.downloads import download_source_file, run_in_parse_pool, save_download_metadata, source_download_slot
+from backend.models import db, db_write_lock, Session, Epg, Channel, EpgChannels, EpgChannelProgrammes
 from backend.tvheadend.tvh_requests import get_tvh
+from source_parsers import parse_xmltv_file, read_xmltv_spool
 
 logger = logging.getLogger('tic.epgs')
 
@@ -135,17 +135,17 @@ async def clear_epg_channel_data(epg_id):
 
 
 async def download_xmltv_epg(url, output):
+    """
+    Download an XMLTV file to the given cache file if it has changed since it was last imported.
+    Returns the download metadata to save once it has been imported, or None if it is unchanged.
+    """
     logger.info("Downloading EPG from url - '%s'", url)
-    if not os.path.exists(os.path.dirname(output)):
-        os.makedirs(os.path.dirname(output))
     headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0"}
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            response.raise_for_status()
-            async with aiofiles.open(output, 'wb') as f:
-                async for chunk in response.content.iter_chunked(8192):
-                    await f.write(chunk)
-    await try_unzip(output)
+    metadata_file = f"{os.path.splitext(output)[0]}.yml"
+    download_metadata = await download_source_file(url, output, metadata_file, headers=headers)
+    if download_metadata:
+        await try_unzip(output)
+    return download_metadata
 
 
 async def try_unzip(output: str) -> None:
@@ -159,149 +159,94 @@ async def try_unzip(output: str) -> None:
         pass
 
 
-async def store_epg_channels(config, epg_id):
-    xmltv_file = os.path.join(config.config_path, 'cache', 'epgs', f"{epg_id}.xml")
-    if not os.path.exists(xmltv_file):
-        logger.info("No such file '%s'", xmltv_file)
-        return False
-    # Read and parse XML file contents asynchronously
-    async with aiofiles.open(xmltv_file, mode='r', encoding="utf8", errors='ignore') as f:
-        contents = await f.read()
-    input_file = ET.ElementTree(ET.fromstring(contents))
+async def store_epg_channels(epg_id, channels):
+    """Replace the channels of an EPG. Returns a dict of the XMLTV channel IDs to their new DB IDs."""
     async with Session() as session:
         async with session.begin():
             # Delete all existing EPG channels
-            stmt = delete(EpgChannels).where(EpgChannels.epg_id == epg_id)
-            await session.execute(stmt)
+            await session.execute(delete(EpgChannels).where(EpgChannels.epg_id == epg_id))
             # Add an updated list of channels from the XML file to the DB
-            logger.info("Updating channels list for EPG #%s from path - '%s'", epg_id, xmltv_file)
-            items = []
-            channel_id_list = []
-            for channel in input_file.iterfind('.//channel'):
-                channel_id = channel.get('id')
-                display_name = channel.find('display-name').text
-                icon = ''
-                icon_elem = channel.find('icon')
-                if icon_elem is not None:
-                    icon = icon_elem.attrib.get('src', '')
-                logger.debug("Channel ID: '%s', Display Name: '%s', Icon: %s", channel_id, display_name, icon)
-                items.append({
-                    'epg_id':     epg_id,
-                    'channel_id': channel_id,
-                    'name':       display_name,
-                    'icon_url':   icon,
-                })
-                channel_id_list.append(channel_id)
-            # Perform bulk insert
-            await session.execute(insert(EpgChannels), items)
-            # Commit all updates to channels
-            await session.commit()
-            logger.info("Successfully imported %s channels from path - '%s'", len(channel_id_list), xmltv_file)
-        # Return list of channels
-        return channel_id_list
-
-
-async def store_epg_programmes(config, epg_id, channel_id_list):
-    xmltv_file = os.path.join(config.config_path, 'cache', 'epgs', f"{epg_id}.xml")
-    if not os.path.exists(xmltv_file):
-        # TODO: Add error logging here
-        logger.info("No such file '%s'", xmltv_file)
-        return False
-
-    def parse_and_save_programmes():
-        # Open file
-        input_file = ET.parse(xmltv_file)
-
-        # For each channel, create a list of programmes
-        logger.info("Fetching list of channels from EPG #%s from database", epg_id)
-        channel_ids = {}
-        for channel_id in channel_id_list:
-            epg_channel = db.session.query(EpgChannels) \
-                .filter(and_(EpgChannels.channel_id == channel_id,
-                             EpgChannels.epg_id == epg_id
-                             )) \
-                .first()
-            channel_ids[channel_id] = epg_channel.id
-        # Add an updated list of programmes from the XML file to the DB
-        logger.info("Updating new programmes list for EPG #%s from path - '%s'", epg_id, xmltv_file)
-        items = []
-        for programme in input_file.iterfind(".//programme"):
-            if len(items) > 1000:
-                db.session.bulk_save_objects(items, update_changed_only=False)
-                items = []
-            channel_id = programme.attrib.get('channel', None)
-            if channel_id in channel_ids:
-                epg_channel_id = channel_ids.get(channel_id)
-                # Parse attributes first
-                start = programme.attrib.get('start', None)
-                stop = programme.attrib.get('stop', None)
-                start_timestamp = programme.attrib.get('start_timestamp', None)
-                stop_timestamp = programme.attrib.get('stop_timestamp', None)
-                # Parse sub-elements
-                title = programme.findtext("title", default=None)
-                sub_title = programme.findtext("sub-title", default=None)
-                desc = programme.findtext("desc", default=None)
-                series_desc = programme.findtext("series-desc", default=None)
-                country = programme.findtext("country", default=None)
-                # Import icon
-                icon = programme.find("icon")
-                icon_url = icon.attrib.get('src', None) if icon is not None else None
-                # Import categories
-                categories = []
-                for category in programme.findall("category"):
-                    categories.append(category.text)
-                # TODO: Import rating
-                # TODO: Import star rating
-                # Create new line entry for the programmes table
-                items.append(
-                    EpgChannelProgrammes(
-                        epg_channel_id=epg_channel_id,
-                        channel_id=channel_id,
-                        title=title,
-                        sub_title=sub_title,
-                        desc=desc,
-                        series_desc=series_desc,
-                        icon_url=icon_url,
-                        country=country,
-                        start=start,
-                        stop=stop,
-                        start_timestamp=start_timestamp,
-                        stop_timestamp=stop_timestamp,
-                        categories=json.dumps(categories)
-                    )
-                )
-        logger.info("Saving new programmes list for EPG #%s from path - '%s'", epg_id, xmltv_file)
-        # Save remaining
-        db.session.bulk_save_objects(items, update_changed_only=False)
-        # Commit all updates to channel programmes
-        db.session.commit()
-        logger.info("Successfully imported %s programmes from path - '%s'", len(items), xmltv_file)
-
-    await run_sync(parse_and_save_programmes)()
+            logger.info("Updating channels list for EPG #%s", epg_id)
+            if channels:
+                await session.execute(insert(EpgChannels), [dict(channel, epg_id=epg_id) for channel in channels])
+            result = await session.execute(
+                select(EpgChannels.channel_id, EpgChannels.id).where(EpgChannels.epg_id == epg_id))
+            epg_channel_ids = {channel_id: row_id for channel_id, row_id in result.all()}
+    logger.info("Successfully imported %s channels for EPG #%s", len(channels), epg_id)
+    return epg_channel_ids
+
+
+async def store_epg_programmes(epg_id, programme_batches, epg_channel_ids):
+    """
+    Insert batches of programmes of an EPG's channels. Programmes for unknown channels are skipped.
+    Each batch is read from the programme_batches iterator in a thread, so reading the spool file does not block the
+    event loop.
+    """
+    logger.info("Saving new programmes list for EPG #%s", epg_id)
+    count = 0
+    async with Session() as session:
+        async with session.begin():
+            while (programmes := await asyncio.to_thread(next, programme_batches, None)) is not None:
+                batch = []
+                for programme in programmes:
+                    epg_channel_id = epg_channel_ids.get(programme['channel_id'])
+                    if epg_channel_id is None:
+                        continue
+                    programme['epg_channel_id'] = epg_channel_id
+                    batch.append(programme)
+                if batch:
+                    await session.execute(insert(EpgChannelProgrammes), batch)
+                    count += len(batch)
+    logger.info("Successfully imported %s programmes for EPG #%s", count, epg_id)
 
 
 async def import_epg_data(config, epg_id):
+    """Refresh an EPG's channels and programmes from its source. Returns True if the EPG had changed."""
     epg = await read_config_one_epg(epg_id)
-    # Download a new local copy of the EPG
-    logger.info("Downloading updated XMLTV file for EPG #%s from url - '%s'", epg_id, epg['url'])
-    start_time = time.time()
     xmltv_file = os.path.join(config.config_path, 'cache', 'epgs', f"{epg_id}.xml")
-    await download_xmltv_epg(epg['url'], xmltv_file)
+    async with source_download_slot(epg['url']):
+        # Download a new local copy of the EPG
+        logger.info("Downloading updated XMLTV file for EPG #%s from url - '%s'", epg_id, epg['url'])
+        start_time = time.time()
+        download_metadata = await download_xmltv_epg(epg['url'], xmltv_file)
     execution_time = time.time() - start_time
+    if not download_metadata:
+        logger.info("XMLTV file for EPG #%s is unchanged, checked in '%s' seconds", epg_id, int(execution_time))
+        return False
     logger.info("Updated XMLTV file for EPG #%s was downloaded in '%s' seconds", epg_id, int(execution_time))
     # Read and save EPG data to DB
     logger.info("Importing updated data for EPG #%s", epg_id)
     start_time = time.time()
-    await clear_epg_channel_data(epg_id)
-    channel_id_list = await store_epg_channels(config, epg_id)
-    await store_epg_programmes(config, epg_id, channel_id_list)
+    # The programmes are parsed into a spool file and read back in batches
+    spool_file = f"{xmltv_file}.spool"
+    try:
+        channels, programme_count = await run_in_parse_pool(parse_xmltv_file, xmltv_file, spool_file)
+        logger.info("Parsed %s channels and %s programmes for EPG #%s", len(channels), programme_count, epg_id)
+        async with db_write_lock:
+            await clear_epg_channel_data(epg_id)
+            epg_channel_ids = await store_epg_channels(epg_id, channels)
+            await store_epg_programmes(epg_id, read_xmltv_spool(spool_file), epg_channel_ids)
+    finally:
+        if os.path.exists(spool_file):
+            os.remove(spool_file)
+    # Only record the download once it has been imported, so a failed import is retried next time
+    save_download_metadata(os.path.join(config.config_path, 'cache', 'epgs', f"{epg_id}.yml"), download_metadata)
     execution_time = time.time() - start_time
     logger.info("Updated data for EPG #%s was imported in '%s' seconds", epg_id, int(execution_time))
+    return True
 
 
 async def import_epg_data_for_all_epgs(config):
-    for epg in db.session.query(Epg).all():
-        await import_epg_data(config, epg.id)
+    """Refresh all enabled EPGs concurrently, within the source download limits."""
+    async with Session() as session:
+        result = await session.execute(select(Epg.id).where(Epg.enabled == True))
+        epg_ids = result.scalars().all()
+    start_time = time.time()
+    results = await asyncio.gather(*[import_epg_data(config, epg_id) for epg_id in epg_ids], return_exceptions=True)
+    for epg_id, result in zip(epg_ids, results):
+        if isinstance(result, Exception):
+            logger.error("Failed to refresh EPG #%s - %s", epg_id, result)
+    logger.info("Refreshed %s EPGs in '%s' seconds", len(epg_ids), int(time.time() - start_time))
 
 
 async def read_channels_from_all_epgs(config):
@@ -82,7 +82,11 @@ async def ffprobe_file(vid_file_path):
 def generate_iptv_url(config, url='', service_name=''):
     if not url.startswith('pipe://'):
         settings = config.read_settings()
-        if settings['settings']['enable_stream_buffer']:
+        if settings['settings']['use_tic_stream_relay'] and settings['settings']['app_url']:
+            # Pull the stream through this application's shared relay so that each upstream is only opened once
+            from backend.api.routes_hls_proxy import generate_stream_relay_url
+            url = generate_stream_relay_url(settings['settings']['app_url'], url)
+        elif settings['settings']['enable_stream_buffer']:
             ffmpeg_args = settings['settings']['default_ffmpeg_pipe_args']
             ffmpeg_args = ffmpeg_args.replace("[URL]", url)
             service_name = re.sub(r'[^a-zA-Z0-9 \n\.]', '', service_name)
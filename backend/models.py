@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding:utf-8 -*-
+import asyncio
+
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, Table, MetaData
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
@@ -13,6 +15,10 @@ Base = declarative_base(metadata=metadata)
 engine = create_async_engine(config.sqlalchemy_database_async_uri, echo=config.enable_sqlalchemy_debugging)
 Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+# Held while writing an imported source to the DB. Sources are refreshed concurrently, but their bulk writes are
+# applied one at a time so that SQLite never has competing writers.
+db_write_lock = asyncio.Lock()
+
 # Use of 'db' in this project is now deprecated and will be removed in a future release. Use Session instead.
 db = SQLAlchemy()
 
@@ -113,6 +119,8 @@ class Playlist(Base):
     use_hls_proxy = Column(Boolean, nullable=False, unique=False)
     use_custom_hls_proxy = Column(Boolean, nullable=False, unique=False)
     hls_proxy_path = Column(String(256), unique=False)
+    hls_proxy_prefetch_segments = Column(Integer, nullable=True, unique=False)
+    hls_proxy_prefetch_concurrency = Column(Integer, nullable=True, unique=False)
 
     # Backref to all associated linked sources
     channel_sources = relationship('ChannelSource', backref='playlist', lazy=True, cascade="all, delete-orphan")
@@ -134,6 +142,10 @@ class PlaylistStreams(Base):
     tvg_id = Column(String(500), index=True, unique=False)
     tvg_logo = Column(String(500), index=False, unique=False)
 
+    # Identify a stream across imports so a re-import only touches the rows that changed
+    stream_key = Column(String(64), index=True, unique=False)
+    row_hash = Column(String(64), index=False, unique=False)
+
     # Link with a playlist
     playlist_id = Column(Integer, ForeignKey('playlists.id'), nullable=False)
 
@@ -1,21 +1,33 @@
 #!/usr/bin/env python3
 # -*- coding:utf-8 -*-
+import asyncio
+import codecs
 import logging
 import os
+import pickle
+import re
+import tempfile
 
 import aiofiles
-import aiohttp
 import time
 from operator import attrgetter
-from sqlalchemy import or_, select, delete, insert, func
+from sqlalchemy import or_, select, func, text, table, column, literal_column
 from sqlalchemy.orm import joinedload
 
+from backend.downloads import download_source_file, run_in_parse_pool, save_download_metadata, source_download_slot
 from backend.ffmpeg import ffprobe_file
-from backend.models import db, Session, Playlist, PlaylistStreams
+from backend.models import db, db_write_lock, Session, Playlist, PlaylistStreams
 from backend.tvheadend.tvh_requests import get_tvh, network_template
+from source_parsers import PLAYLIST_STREAM_COLUMNS, parse_m3u_lines
 
 logger = logging.getLogger('tic.playlists')
 
+# Number of parsed streams written to the DB per insert while importing a playlist
+PLAYLIST_IMPORT_BATCH_SIZE = 2000
+
+# The FTS5 full text index of playlist stream names, group titles and tvg-ids (created by a migration)
+playlist_streams_fts = table('playlist_streams_fts', column('rowid'), column('rank'))
+
 
 async def read_config_all_playlists(config, output_for_export=False):
     return_list = []
@@ -28,24 +40,28 @@ async def read_config_all_playlists(config, output_for_export=False):
             for result in results:
                 if output_for_export:
                     return_list.append({
-                        'enabled':              result.enabled,
-                        'connections':          result.connections,
-                        'name':                 result.name,
-                        'url':                  result.url,
-                        'use_hls_proxy':        result.use_hls_proxy,
-                        'use_custom_hls_proxy': result.use_custom_hls_proxy,
-                        'hls_proxy_path':       result.hls_proxy_path if result.hls_proxy_path else f'{app_url}/tic-hls-proxy/[B64_URL].m3u8',
+                        'enabled':                        result.enabled,
+                        'connections':                    result.connections,
+                        'name':                           result.name,
+                        'url':                            result.url,
+                        'use_hls_proxy':                  result.use_hls_proxy,
+                        'use_custom_hls_proxy':           result.use_custom_hls_proxy,
+                        'hls_proxy_path':                 result.hls_proxy_path if result.hls_proxy_path else f'{app_url}/tic-hls-proxy/[B64_URL].m3u8',
+                        'hls_proxy_prefetch_segments':    result.hls_proxy_prefetch_segments,
+                        'hls_proxy_prefetch_concurrency': result.hls_proxy_prefetch_concurrency,
                     })
                     continue
                 return_list.append({
-                    'id':                   result.id,
-                    'enabled':              result.enabled,
-                    'connections':          result.connections,
-                    'name':                 result.name,
-                    'url':                  result.url,
-                    'use_hls_proxy':        result.use_hls_proxy,
-                    'use_custom_hls_proxy': result.use_custom_hls_proxy,
-                    'hls_proxy_path':       result.hls_proxy_path if result.hls_proxy_path else f'{app_url}/tic-hls-proxy/[B64_URL].m3u8',
+                    'id':                             result.id,
+                    'enabled':                        result.enabled,
+                    'connections':                    result.connections,
+                    'name':                           result.name,
+                    'url':                            result.url,
+                    'use_hls_proxy':                  result.use_hls_proxy,
+                    'use_custom_hls_proxy':           result.use_custom_hls_proxy,
+                    'hls_proxy_path':                 result.hls_proxy_path if result.hls_proxy_path else f'{app_url}/tic-hls-proxy/[B64_URL].m3u8',
+                    'hls_proxy_prefetch_segments':    result.hls_proxy_prefetch_segments,
+                    'hls_proxy_prefetch_concurrency': result.hls_proxy_prefetch_concurrency,
                 })
     return return_list
 
@@ -61,14 +77,16 @@ async def read_config_one_playlist(config, playlist_id):
             app_url = settings['settings']['app_url']
             if result:
                 return_item = {
-                    'id':                   result.id,
-                    'enabled':              result.enabled,
-                    'name':                 result.name,
-                    'url':                  result.url,
-                    'connections':          result.connections,
-                    'use_hls_proxy':        result.use_hls_proxy,
-                    'use_custom_hls_proxy': result.use_custom_hls_proxy,
-                    'hls_proxy_path':       result.hls_proxy_path if result.hls_proxy_path else f'{app_url}/tic-hls-proxy/[B64_URL].m3u8',
+                    'id':                             result.id,
+                    'enabled':                        result.enabled,
+                    'name':                           result.name,
+                    'url':                            result.url,
+                    'connections':                    result.connections,
+                    'use_hls_proxy':                  result.use_hls_proxy,
+                    'use_custom_hls_proxy':           result.use_custom_hls_proxy,
+                    'hls_proxy_path':                 result.hls_proxy_path if result.hls_proxy_path else f'{app_url}/tic-hls-proxy/[B64_URL].m3u8',
+                    'hls_proxy_prefetch_segments':    result.hls_proxy_prefetch_segments,
+                    'hls_proxy_prefetch_concurrency': result.hls_proxy_prefetch_concurrency,
                 }
     return return_item
 
@@ -86,6 +104,8 @@ async def add_new_playlist(config, data):
                 use_hls_proxy=data.get('use_hls_proxy', False),
                 use_custom_hls_proxy=data.get('use_custom_hls_proxy', False),
                 hls_proxy_path=data.get('hls_proxy_path', f'{app_url}/tic-hls-proxy/[B64_URL].m3u8'),
+                hls_proxy_prefetch_segments=data.get('hls_proxy_prefetch_segments'),
+                hls_proxy_prefetch_concurrency=data.get('hls_proxy_prefetch_concurrency'),
             )
             # This is a new entry. Add it to the session before commit
             session.add(playlist)
@@ -105,6 +125,10 @@ async def update_playlist(config, playlist_id, data):
             playlist.use_hls_proxy = data.get('use_hls_proxy', playlist.use_hls_proxy)
             playlist.use_custom_hls_proxy = data.get('use_custom_hls_proxy', playlist.use_custom_hls_proxy)
             playlist.hls_proxy_path = data.get('hls_proxy_path', playlist.hls_proxy_path)
+            playlist.hls_proxy_prefetch_segments = data.get('hls_proxy_prefetch_segments',
+                                                            playlist.hls_proxy_prefetch_segments)
+            playlist.hls_proxy_prefetch_concurrency = data.get('hls_proxy_prefetch_concurrency',
+                                                               playlist.hls_proxy_prefetch_concurrency)
     # Publish changes to TVH
     await publish_playlist_networks(config)
 
@@ -133,58 +157,222 @@ async def delete_playlist(config, playlist_id):
             await session.delete(playlist)
 
 
-async def download_playlist_file(url, output):
+class M3uStreamParser:
+    """
+    Incremental, line oriented parser for M3U (m3u_plus) playlists.
+
+    Data is fed in arbitrary sized chunks of bytes as it is read from the network or disk, and the streams completed
+    by each chunk are returned as staging table rows. The complete lines of each chunk are parsed in the parse worker
+    pool.
+    Only the current partial line and #EXTINF entry are held between chunks, so memory use does not depend on the
+    size of the playlist.
+    """
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        self.partial_line = ''
+        self.extinf = None
+        self.count = 0
+
+    async def feed(self, data):
+        """Parse a chunk of the playlist. Returns a list of the streams completed by it."""
+        text = self.partial_line + self.decoder.decode(data)
+        # The last line may continue in the next chunk
+        end = text.rfind('\n') + 1
+        self.partial_line = text[end:]
+        return await self._parse(text[:end])
+
+    async def close(self):
+        """Parse whatever remains once all the data has been fed. Returns a list of the streams completed by it."""
+        text = self.partial_line + self.decoder.decode(b'', final=True)
+        self.partial_line = ''
+        return await self._parse(text)
+
+    async def _parse(self, text):
+        if not text:
+            return []
+        streams, self.extinf = await run_in_parse_pool(parse_m3u_lines, text, self.extinf)
+        self.count += len(streams)
+        return streams
+
+
+class PlaylistStreamsWriter:
+    """
+    Applies the streams parsed during an import to those stored for a playlist, as a diff.
+
+    While the playlist downloads, parsed streams are spooled in fixed size batches to an anonymous temporary file,
+    so no DB connection or transaction is held during network I/O. Once the import is complete, the spooled streams
+    are loaded into a temporary table, which lives in SQLite's separate temp database. Then rows whose stream has
+    disappeared are deleted, rows whose details changed are updated and new streams are inserted, with a few set
+    based statements in the same transaction. Unchanged streams are not touched and keep their IDs.
+
+    A stream is keyed by its identity (see playlist_stream_staging_row) plus its occurrence number among streams
+    with the same identity, so duplicate entries each keep their own row.
+    """
+
+    staging_table = 'playlist_streams_import'
+    columns = PLAYLIST_STREAM_COLUMNS
+
+    def __init__(self, playlist_id, batch_size=PLAYLIST_IMPORT_BATCH_SIZE):
+        self.playlist_id = playlist_id
+        self.batch_size = batch_size
+        self.batch = []
+        self.spool = None
+        self.count = 0
+
+    async def add(self, rows):
+        """Stage rows produced by playlist_stream_staging_row()."""
+        self.batch.extend(rows)
+        if len(self.batch) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        """Write the current batch to the spool file."""
+        if not self.batch:
+            return
+        if self.spool is None:
+            self.spool = tempfile.TemporaryFile()
+        await asyncio.to_thread(pickle.dump, self.batch, self.spool, pickle.HIGHEST_PROTOCOL)
+        self.count += len(self.batch)
+        self.batch = []
+
+    def _read_spooled_batch(self):
+        try:
+            return pickle.load(self.spool)
+        except EOFError:
+            return None
+
+    async def load(self, session):
+        """Load the spooled streams into the staging table of the given session's connection."""
+        await self.flush()
+        await session.execute(text(f"DROP TABLE IF EXISTS temp.{self.staging_table}"))
+        await session.execute(text(
+            f"CREATE TEMP TABLE {self.staging_table} ("
+            "seq INTEGER PRIMARY KEY, identity TEXT NOT NULL, stream_key TEXT, row_hash TEXT NOT NULL, "
+            "name TEXT, url TEXT, channel_id TEXT, group_title TEXT, tvg_chno INTEGER, tvg_id TEXT, tvg_logo TEXT)"
+        ))
+        if self.spool is None:
+            return
+        await asyncio.to_thread(self.spool.seek, 0)
+        connection = await session.connection()
+        while (batch := await asyncio.to_thread(self._read_spooled_batch)) is not None:
+            # The rows are already in column order, so pass them straight to the driver
+            await connection.exec_driver_sql(
+                f"INSERT INTO {self.staging_table} (identity, row_hash, {', '.join(self.columns)}) "
+                f"VALUES ({', '.join('?' * (len(self.columns) + 2))})",
+                batch)
+
+    async def apply(self, session):
+        """
+        Apply the streams loaded into the staging table to the playlist.
+        Returns the number of rows inserted, updated and deleted.
+        """
+        staging_table = self.staging_table
+        params = {'playlist_id': self.playlist_id}
+        # Number duplicate identities in playlist order to give every staged stream a unique key
+        await session.execute(text(
+            f"UPDATE {staging_table} SET stream_key = numbered.identity || '-' || numbered.occurrence "
+            f"FROM (SELECT seq, identity, ROW_NUMBER() OVER (PARTITION BY identity ORDER BY seq) AS occurrence "
+            f"      FROM {staging_table}) AS numbered "
+            f"WHERE {staging_table}.seq = numbered.seq"
+        ))
+        await session.execute(text(
+            f"CREATE INDEX temp.ix_{staging_table}_stream_key ON {staging_table} (stream_key)"
+        ))
+        # Rows imported before streams were keyed have no key and are replaced
+        deleted = await session.execute(text(
+            f"DELETE FROM playlist_streams WHERE playlist_id = :playlist_id AND (stream_key IS NULL OR NOT EXISTS "
+            f"(SELECT 1 FROM {staging_table} AS staged WHERE staged.stream_key = playlist_streams.stream_key))"
+        ), params)
+        updated = await session.execute(text(
+            f"UPDATE playlist_streams SET row_hash = staged.row_hash, "
+            f"{', '.join(f'{column} = staged.{column}' for column in self.columns)} "
+            f"FROM {staging_table} AS staged "
+            f"WHERE playlist_streams.playlist_id = :playlist_id AND playlist_streams.stream_key = staged.stream_key "
+            f"AND playlist_streams.row_hash IS NOT staged.row_hash"
+        ), params)
+        inserted = await session.execute(text(
+            f"INSERT INTO playlist_streams (playlist_id, stream_key, row_hash, {', '.join(self.columns)}) "
+            f"SELECT :playlist_id, stream_key, row_hash, {', '.join(self.columns)} FROM {staging_table} AS staged "
+            f"WHERE NOT EXISTS (SELECT 1 FROM playlist_streams "
+            f"                  WHERE playlist_id = :playlist_id AND stream_key = staged.stream_key) "
+            f"ORDER BY seq"
+        ), params)
+        await session.execute(text(f"DROP TABLE temp.{staging_table}"))
+        return inserted.rowcount, updated.rowcount, deleted.rowcount
+
+    def close(self):
+        """Discard the spooled streams."""
+        self.batch = []
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
+
+async def download_playlist_file(url, output, on_chunk=None):
+    """
+    Download a playlist to the given cache file if it has changed since it was last imported.
+    Returns the download metadata to save once it has been imported, or None if it is unchanged.
+    If given, the on_chunk coroutine is awaited with each chunk as it arrives, so the playlist can be imported
+    while it downloads.
+    """
     logger.info("Downloading Playlist from url - '%s'", url)
-    if not os.path.exists(os.path.dirname(output)):
-        os.makedirs(os.path.dirname(output))
     headers = {
         'User-Agent': 'VLC/3.0.0-git LibVLC/3.0.0-gi',
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            response.raise_for_status()
-            async with aiofiles.open(output, 'wb') as f:
-                async for chunk in response.content.iter_chunked(8192):
-                    await f.write(chunk)
-    return output
+    metadata_file = f"{os.path.splitext(output)[0]}.yml"
+    return await download_source_file(url, output, metadata_file, headers=headers, on_chunk=on_chunk)
+
+
+async def import_playlist_streams(playlist_id, read_chunks, source):
+    """
+    Parse a playlist from the chunks produced by the read_chunks coroutine function, which is called with the
+    coroutine to pass each chunk to, and update the playlist's streams to match.
+    If read_chunks returns a false value, the playlist has not changed and nothing is imported.
+    Returns the result of read_chunks.
+    """
+    parser = M3uStreamParser()
+    writer = PlaylistStreamsWriter(playlist_id)
+    try:
+        logger.info("Updating list of available streams for playlist #%s from %s", playlist_id, source)
+
+        async def on_chunk(chunk):
+            await writer.add(await parser.feed(chunk))
+
+        result = await read_chunks(on_chunk)
+        if not result:
+            logger.info("Streams for playlist #%s are unchanged, skipping import", playlist_id)
+            return result
+        await writer.add(await parser.close())
+        # Only connect to the DB once everything has been read and parsed. Hold the DB write lock until the
+        # transaction has committed, so no other import writes while SQLite still holds this one's write lock.
+        async with db_write_lock:
+            async with Session() as session:
+                async with session.begin():
+                    await writer.load(session)
+                    inserted, updated, deleted = await writer.apply(session)
+    finally:
+        writer.close()
+    logger.info("Successfully imported %s streams from %s - %s new, %s updated, %s removed", writer.count, source,
+                inserted, updated, deleted)
+    return result
 
 
 async def store_playlist_streams(config, playlist_id):
+    """Import the streams of a playlist from its cached M3U file."""
     m3u_file = os.path.join(config.config_path, 'cache', 'playlists', f"{playlist_id}.m3u")
     if not os.path.exists(m3u_file):
         logger.error("No such file '%s'", m3u_file)
         return False
-    # Read cache file contents asynchronously
-    async with aiofiles.open(m3u_file, mode='r', encoding="utf8", errors='ignore') as f:
-        contents = await f.read()
-    # noinspection PyPackageRequirements
-    from ipytv import playlist
-    pl = playlist.loads(contents)
-    async with Session() as session:
-        async with session.begin():
-            # Delete all existing playlist streams
-            stmt = delete(PlaylistStreams).where(PlaylistStreams.playlist_id == playlist_id)
-            await session.execute(stmt)
-            # Add an updated list of streams from the M3U file to the DB
-            logger.info("Updating list of available streams for playlist #%s from path - '%s'", playlist_id, m3u_file)
-            items = []
-            for stream in pl:
-                tvg_channel_number = stream.attributes.get('tvg-chno')
-                items.append({
-                    'playlist_id': playlist_id,
-                    'name':        stream.name,
-                    'url':         stream.url,
-                    'channel_id':  stream.attributes.get('channel-id'),
-                    'group_title': stream.attributes.get('group-title'),
-                    'tvg_chno':    int(tvg_channel_number) if tvg_channel_number is not None else None,
-                    'tvg_id':      stream.attributes.get('tvg-id'),
-                    'tvg_logo':    stream.attributes.get('tvg-logo'),
-                })
-            # Perform bulk insert
-            await session.execute(insert(PlaylistStreams), items)
-            # Commit all updates to playlist sources
-            await session.commit()
-            logger.info("Successfully imported %s streams from path - '%s'", len(items), m3u_file)
+
+    async def read_chunks(on_chunk):
+        async with aiofiles.open(m3u_file, mode='rb') as f:
+            while chunk := await f.read(65536):
+                await on_chunk(chunk)
+        return True
+
+    await import_playlist_streams(playlist_id, read_chunks, f"path - '{m3u_file}'")
+    return True
 
 
 def fetch_playlist_streams(playlist_id):
@@ -202,28 +390,54 @@ def fetch_playlist_streams(playlist_id):
     return return_list
 
 
-async def import_playlist_data(config, playlist_id):
+async def import_playlist_data(config, playlist_id, publish=True):
+    """
+    Refresh a playlist's streams from its source. Returns True if the playlist had changed.
+    Unless publish is False, changes are then published to TVH.
+    """
     playlist = await read_config_one_playlist(config, playlist_id)
-    # Download playlist data and save to YAML cache file
-    logger.info("Downloading updated M3U file for playlist #%s from url - '%s'", playlist_id, playlist['url'])
-    start_time = time.time()
     m3u_file = os.path.join(config.config_path, 'cache', 'playlists', f"{playlist_id}.m3u")
-    await download_playlist_file(playlist['url'], m3u_file)
-    execution_time = time.time() - start_time
-    logger.info("Updated M3U file for playlist #%s was downloaded in '%s' seconds", playlist_id, int(execution_time))
-    # Parse the M3U file and cache the data in a YAML file for faster parsing
-    logger.info("Importing updated data for playlist #%s", playlist_id)
-    start_time = time.time()
-    await store_playlist_streams(config, playlist_id)
+    async with source_download_slot(playlist['url']):
+        # Download the M3U file to the cache, importing its streams as it arrives
+        logger.info("Downloading and importing updated M3U file for playlist #%s from url - '%s'", playlist_id,
+                    playlist['url'])
+        start_time = time.time()
+        download_metadata = await import_playlist_streams(
+            playlist_id,
+            lambda on_chunk: download_playlist_file(playlist['url'], m3u_file, on_chunk),
+            f"url - '{playlist['url']}'")
     execution_time = time.time() - start_time
-    logger.info("Updated data for playlist #%s was imported in '%s' seconds", playlist_id, int(execution_time))
-    # Publish changes to TVH
-    await publish_playlist_networks(config)
+    if not download_metadata:
+        logger.info("Playlist #%s is unchanged, checked in '%s' seconds", playlist_id, int(execution_time))
+        return False
+    # Only record the download once its streams have been imported, so a failed import is retried next time
+    save_download_metadata(os.path.join(config.config_path, 'cache', 'playlists', f"{playlist_id}.yml"),
+                           download_metadata)
+    logger.info("Updated data for playlist #%s was downloaded and imported in '%s' seconds", playlist_id,
+                int(execution_time))
+    if publish:
+        # Publish changes to TVH
+        await publish_playlist_networks(config)
+    return True
 
 
 async def import_playlist_data_for_all_playlists(config):
-    for playlist in db.session.query(Playlist).all():
-        await import_playlist_data(config, playlist.id)
+    """
+    Refresh all enabled playlists concurrently, within the source download limits.
+    The playlists are published to TVH once at the end if any of them changed.
+    """
+    async with Session() as session:
+        result = await session.execute(select(Playlist.id).where(Playlist.enabled == True))
+        playlist_ids = result.scalars().all()
+    start_time = time.time()
+    results = await asyncio.gather(*[import_playlist_data(config, playlist_id, publish=False)
+                                     for playlist_id in playlist_ids], return_exceptions=True)
+    for playlist_id, result in zip(playlist_ids, results):
+        if isinstance(result, Exception):
+            logger.error("Failed to refresh playlist #%s - %s", playlist_id, result)
+    logger.info("Refreshed %s playlists in '%s' seconds", len(playlist_ids), int(time.time() - start_time))
+    if any(result is True for result in results):
+        await publish_playlist_networks(config)
 
 
 async def read_stream_details_from_all_playlists():
@@ -246,37 +460,75 @@ async def read_stream_details_from_all_playlists():
     return playlist_streams
 
 
+def build_stream_search_query(search_value, column_name=None):
+    """
+    Build an FTS5 query matching playlist streams with words starting with each word of the search value.
+    Optionally only match the given column of the index. Returns None if the search value has no words.
+    """
+    terms = [f'"{term}"*' for term in re.findall(r'\w+', search_value)]
+    if not terms:
+        return None
+    query = ' '.join(terms)
+    if column_name:
+        query = f"{column_name} : ({query})"
+    return query
+
+
+def stream_search_matches(fts_query):
+    """Select the IDs and rank (best first) of the playlist streams matching an FTS5 query."""
+    return (
+        select(playlist_streams_fts.c.rowid.label('stream_id'), playlist_streams_fts.c.rank.label('rank'))
+        .where(literal_column('playlist_streams_fts').op('MATCH')(fts_query))
+        .subquery()
+    )
+
+
 def read_filtered_stream_details_from_all_playlists(request_json):
     results = {
         'streams':          [],
         'records_total':    0,
         'records_filtered': 0,
     }
-    query = db.session.query(PlaylistStreams)
+    query = db.session.query(PlaylistStreams).options(joinedload(PlaylistStreams.playlist))
     # Get total records count
-    results['records_total'] = query.count()
+    results['records_total'] = db.session.query(func.count(PlaylistStreams.id)).scalar()
+    results['records_filtered'] = results['records_total']
     # Filter results by search value
     search_value = request_json.get('search_value')
+    search_rank = None
     if search_value:
-        playlist_rows = (
-            db.session.query(Playlist)
-            .where(Playlist.name.contains(search_value))
-            .all()
-        )
-        query = query.options(joinedload(PlaylistStreams.playlist)).where(
-            or_(PlaylistStreams.name.contains(search_value),
-                PlaylistStreams.playlist_id.in_([p.id for p in playlist_rows])))
-    # Record filtered records count
-    results['records_filtered'] = query.count()
-    # Get order by
+        playlist_ids = [
+            playlist_id for playlist_id, in
+            db.session.query(Playlist.id).where(Playlist.name.contains(search_value)).all()
+        ]
+        fts_query = build_stream_search_query(search_value)
+        if fts_query is None:
+            # Nothing to look up in the full text index (eg. only punctuation)
+            query = query.where(or_(PlaylistStreams.name.contains(search_value),
+                                    PlaylistStreams.playlist_id.in_(playlist_ids)))
+        else:
+            matches = stream_search_matches(fts_query)
+            search_rank = matches.c.rank
+            if playlist_ids:
+                # Also include every stream of the playlists with a matching name
+                query = query.outerjoin(matches, matches.c.stream_id == PlaylistStreams.id).where(
+                    or_(matches.c.stream_id.isnot(None), PlaylistStreams.playlist_id.in_(playlist_ids)))
+            else:
+                query = query.join(matches, matches.c.stream_id == PlaylistStreams.id)
+        # Record filtered records count
+        results['records_filtered'] = query.count()
+    # Get order by. Search results are ordered by relevance unless a column is given.
     order_by_column = request_json.get('order_by')
-    if not order_by_column:
-        order_by_column = 'name'
-    if request_json.get('order_direction', 'desc') == 'asc':
-        order_by = attrgetter(order_by_column)(PlaylistStreams).asc()
+    if search_rank is not None and order_by_column in (None, '', 'rank'):
+        query = query.order_by(search_rank.is_(None), search_rank, PlaylistStreams.name)
     else:
-        order_by = attrgetter(order_by_column)(PlaylistStreams).desc()
-    query = query.order_by(order_by)
+        if not order_by_column or order_by_column == 'rank':
+            order_by_column = 'name'
+        if request_json.get('order_direction', 'desc') == 'asc':
+            order_by = attrgetter(order_by_column)(PlaylistStreams).asc()
+        else:
+            order_by = attrgetter(order_by_column)(PlaylistStreams).desc()
+        query = query.order_by(order_by)
     # Limit query results
     length = request_json.get('length', 0)
     start = request_json.get('start', 0)
@@ -373,20 +625,32 @@ async def get_playlist_groups(config, playlist_id, start=0, length=10, search_va
             # Get the total count of unique groups
             total_groups = await session.scalar(distinct_groups_count_query)
             
+            # Search the group titles with the full text index
+            matches = None
+            if search_value:
+                fts_query = build_stream_search_query(search_value, 'group_title')
+                if fts_query is not None:
+                    matches = stream_search_matches(fts_query)
+
             # Apply search filter to count if provided
             if search_value:
-                filtered_groups_count_query = select(func.count()).select_from(
+                filtered_groups_query = (
                     select(PlaylistStreams.group_title)
                     .filter(
                         PlaylistStreams.playlist_id == playlist_id,
                         PlaylistStreams.group_title != None,
                         PlaylistStreams.group_title != '',
-                        PlaylistStreams.group_title.ilike(f'%{search_value}%')
                     )
                     .group_by(PlaylistStreams.group_title)
-                    .subquery()
                 )
-                filtered_groups = await session.scalar(filtered_groups_count_query)
+                if matches is not None:
+                    filtered_groups_query = filtered_groups_query.join(
+                        matches, matches.c.stream_id == PlaylistStreams.id)
+                else:
+                    filtered_groups_query = filtered_groups_query.filter(
+                        PlaylistStreams.group_title.ilike(f'%{search_value}%'))
+                filtered_groups = await session.scalar(
+                    select(func.count()).select_from(filtered_groups_query.subquery()))
             else:
                 filtered_groups = total_groups
             
@@ -401,7 +665,9 @@ async def get_playlist_groups(config, playlist_id, start=0, length=10, search_va
             )
             
             # Apply search filter to groups
-            if search_value:
+            if matches is not None:
+                groups_query = groups_query.join(matches, matches.c.stream_id == PlaylistStreams.id)
+            elif search_value:
                 groups_query = groups_query.filter(PlaylistStreams.group_title.ilike(f'%{search_value}%'))
             
             # Group by group name
@@ -418,6 +684,9 @@ async def get_playlist_groups(config, playlist_id, start=0, length=10, search_va
                     groups_query = groups_query.order_by(func.count(PlaylistStreams.id).desc())
                 else:
                     groups_query = groups_query.order_by(func.count(PlaylistStreams.id).asc())
+            elif matches is not None:
+                # Order search results by relevance (best match first)
+                groups_query = groups_query.order_by(func.min(matches.c.rank), PlaylistStreams.group_title)
             
             # Apply pagination
             groups_query = groups_query.offset(start).limit(length)
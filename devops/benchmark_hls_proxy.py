@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Load test for the built-in HLS proxy.
+
+Starts a local fake origin serving synthetic live HLS channels (a rolling manifest plus generated TS segments) and
+raw TS streams, runs the app in a child process pointed at a throwaway config directory, then drives the proxy's
+m3u8/ts and stream relay routes with simulated viewers. The raw TS streams are real test content (colour bars and
+a tone) encoded once by FFmpeg at startup and served in a loop at their own bitrate, so that the proxy's FFmpeg
+relay can demux them.
+
+Reported per run:
+    - manifest and segment TTFB percentiles (time until the first body byte reaches the viewer)
+    - upstream request counts seen by the origin (how well requests are shared and cached)
+    - proxy RSS memory at the start and end of the run
+    - proxy CPU time per viewer
+
+Results can be written as JSON with --output to compare runs before and after a change.
+The benchmark exits with an error if any request failed or nothing was served.
+
+Usage (from the project root, in the project venv):
+
+    python3 ./devops/benchmark_hls_proxy.py --viewers 200 --channels 10 --duration 60
+    python3 ./devops/benchmark_hls_proxy.py --scenario stream --viewers 50 --output before.json
+
+The stream scenarios encode their test content with FFmpeg and relay through it, so they require ffmpeg to be
+installed.
+Requires psutil (see requirements-dev.txt).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from base64 import b64encode
+
+import aiohttp
+import psutil
+from aiohttp import web
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+TS_PACKET_SIZE = 188
+PROXY_PREFIX = 'tic-hls-proxy'
+
+# Length of the test content looped by the raw TS streams
+STREAM_LOOP_SECONDS = 30
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def ts_payload(size, seed=0):
+    """Generate `size` bytes (rounded down to whole packets) of null-ish TS packets with valid sync bytes."""
+    packet_count = max(1, size // TS_PACKET_SIZE)
+    packets = bytearray()
+    for counter in range(packet_count):
+        packets += bytes([0x47, 0x01, 0x00, 0x10 | ((counter + seed) % 16)])
+        packets += bytes(TS_PACKET_SIZE - 4)
+    return bytes(packets)
+
+
+def encode_stream_content(output, bitrate, seconds=STREAM_LOOP_SECONDS):
+    """Encode real MPEG-TS test content (with PAT/PMT, video and audio) with FFmpeg and return it."""
+    subprocess.run([
+        'ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', 'testsrc2=size=640x360:rate=25',
+        '-f', 'lavfi', '-i', 'sine=frequency=1000:sample_rate=48000',
+        '-t', str(seconds),
+        '-c:v', 'mpeg2video', '-b:v', str(bitrate), '-maxrate', str(bitrate), '-bufsize', str(bitrate), '-g', '25',
+        '-c:a', 'mp2', '-b:a', '128k',
+        '-f', 'mpegts', output,
+    ], check=True)
+    with open(output, 'rb') as f:
+        return f.read()
+
+
+class FakeOrigin:
+    """An aiohttp origin serving synthetic live HLS channels and raw TS streams."""
+
+    def __init__(self, port, segment_duration, segment_bytes, window, stream_content, latency):
+        self.port = port
+        self.segment_duration = segment_duration
+        self.segment_bytes = segment_bytes
+        self.window = window
+        self.stream_content = stream_content
+        self.latency = latency
+        self.started = time.time()
+        self.segment_body = ts_payload(segment_bytes)
+        self.requests = {'manifest': 0, 'segment': 0, 'stream': 0}
+        self.runner = None
+
+    def media_sequence(self):
+        return int((time.time() - self.started) / self.segment_duration)
+
+    async def delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def manifest(self, request):
+        self.requests['manifest'] += 1
+        await self.delay()
+        sequence = self.media_sequence()
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:3',
+            f'#EXT-X-TARGETDURATION:{int(self.segment_duration)}',
+            f'#EXT-X-MEDIA-SEQUENCE:{sequence}',
+        ]
+        for number in range(sequence, sequence + self.window):
+            lines.append(f'#EXTINF:{self.segment_duration:.3f},')
+            lines.append(f'seg{number}.ts?token={request.match_info["channel"]}-{number}')
+        return web.Response(text='\n'.join(lines) + '\n', content_type='application/vnd.apple.mpegurl')
+
+    async def segment(self, request):
+        self.requests['segment'] += 1
+        await self.delay()
+        response = web.StreamResponse(headers={'Content-Type': 'video/mp2t'})
+        response.content_length = len(self.segment_body)
+        await response.prepare(request)
+        # Send in a few chunks so that streaming behaviour (rather than only buffering) is exercised
+        chunk_size = 64 * 1024
+        for offset in range(0, len(self.segment_body), chunk_size):
+            await response.write(self.segment_body[offset:offset + chunk_size])
+        await response.write_eof()
+        return response
+
+    async def stream(self, request):
+        self.requests['stream'] += 1
+        if not self.stream_content:
+            return web.Response(status=404)
+        await self.delay()
+        response = web.StreamResponse(headers={'Content-Type': 'video/mp2t'})
+        await response.prepare(request)
+        # Loop the test content, sending 100ms worth at a time to play it out at its own bitrate
+        content = self.stream_content
+        chunk_size = max(1, len(content) // STREAM_LOOP_SECONDS // 10 // TS_PACKET_SIZE) * TS_PACKET_SIZE
+        offset = 0
+        try:
+            while True:
+                await response.write(content[offset:offset + chunk_size])
+                offset += chunk_size
+                if offset >= len(content):
+                    offset = 0
+                await asyncio.sleep(0.1)
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        return response
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/live/{channel}/index.m3u8', self.manifest)
+        app.router.add_get('/live/{channel}/{segment}.ts', self.segment)
+        app.router.add_get('/raw/{channel}.ts', self.stream)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', self.port).start()
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+
+class ProxyProcess:
+    """Runs the app (with only the HTTP server, no background tasks) in a child process."""
+
+    def __init__(self, port, home_dir, env_overrides):
+        self.port = port
+        self.home_dir = home_dir
+        self.env_overrides = env_overrides
+        self.process = None
+        self.ps = None
+
+    def start(self):
+        env = dict(os.environ)
+        env.update({
+            'HOME_DIR':         self.home_dir,
+            'HLS_PROXY_PREFIX': PROXY_PREFIX,
+            'PYTHONPATH':       project_root,
+            'PYTHONUNBUFFERED': '1',
+        })
+        env.update(self.env_overrides)
+        subprocess.run([sys.executable, '-m', 'alembic', 'upgrade', 'head'], cwd=project_root, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        server = (
+            "import asyncio, logging\n"
+            "from hypercorn.asyncio import serve\n"
+            "from hypercorn.config import Config\n"
+            "from backend import create_app\n"
+            "app = create_app()\n"
+            "logging.getLogger().setLevel(logging.WARNING)\n"
+            "for name in ('proxy', 'ffmpeg', 'buffer'):\n"
+            "    logging.getLogger(name).setLevel(logging.WARNING)\n"
+            "config = Config()\n"
+            f"config.bind = ['127.0.0.1:{self.port}']\n"
+            "config.accesslog = None\n"
+            "asyncio.run(serve(app, config))\n"
+        )
+        self.process = subprocess.Popen([sys.executable, '-c', server], cwd=project_root, env=env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.ps = psutil.Process(self.process.pid)
+
+    async def wait_until_ready(self, timeout=30):
+        deadline = time.time() + timeout
+        async with aiohttp.ClientSession() as session:
+            while time.time() < deadline:
+                if self.process.poll() is not None:
+                    raise RuntimeError("Proxy process exited during startup")
+                try:
+                    async with session.get(f'http://127.0.0.1:{self.port}/tic-api/ping') as resp:
+                        if resp.status == 200:
+                            return
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(0.2)
+        raise RuntimeError("Proxy did not start in time")
+
+    def usage(self):
+        """Return the RSS (bytes) and total CPU seconds of the proxy and any FFmpeg children."""
+        rss = 0
+        cpu = 0.0
+        for proc in [self.ps] + self.ps.children(recursive=True):
+            try:
+                rss += proc.memory_info().rss
+                times = proc.cpu_times()
+                cpu += times.user + times.system
+            except psutil.NoSuchProcess:
+                pass
+        return rss, cpu
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+class Results:
+    def __init__(self):
+        self.manifest_ttfb = []
+        self.segment_ttfb = []
+        self.stream_ttfb = []
+        self.segments = 0
+        self.bytes = 0
+        self.errors = {}
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+async def timed_get(session, url, results, ttfb_list, kind):
+    """Fetch a URL, recording the time until the first body byte. Returns the body or None on failure."""
+    start = time.perf_counter()
+    try:
+        async with session.get(url) as resp:
+            if resp.status != 200:
+                results.error(f'{kind}_{resp.status}')
+                await resp.read()
+                return None
+            first = await resp.content.readany()
+            ttfb_list.append(time.perf_counter() - start)
+            body = first + await resp.read()
+            results.bytes += len(body)
+            return body
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        results.error(f'{kind}_connection')
+        return None
+
+
+async def hls_viewer(session, proxy_base, channel_url, segment_duration, stop_at, results):
+    """Behave like a live HLS player: poll the manifest once per target duration and fetch each new segment."""
+    encoded = b64encode(channel_url.encode('utf-8')).decode('utf-8')
+    manifest_url = f'{proxy_base}/{encoded}.m3u8'
+    seen = set()
+    # Stagger start up so that viewers do not all poll in lock step
+    await asyncio.sleep(random.uniform(0, segment_duration))
+    while time.time() < stop_at:
+        started = time.time()
+        body = await timed_get(session, manifest_url, results, results.manifest_ttfb, 'manifest')
+        if body is not None:
+            segment_lines = [line for line in body.decode('utf-8').splitlines() if line and not line.startswith('#')]
+            # Like most players, start three segments from the live edge
+            for line in segment_lines[-3:]:
+                if line in seen:
+                    continue
+                seen.add(line)
+                segment_url = line if line.startswith('http') else f'{proxy_base}/{line}'
+                if await timed_get(session, segment_url, results, results.segment_ttfb, 'segment') is not None:
+                    results.segments += 1
+                if time.time() >= stop_at:
+                    break
+        await asyncio.sleep(max(0.0, segment_duration - (time.time() - started)))
+
+
+async def stream_viewer(session, proxy_base, channel_url, stop_at, results):
+    """Hold a stream relay connection open, reading as fast as data arrives."""
+    encoded = b64encode(channel_url.encode('utf-8')).decode('utf-8')
+    start = time.perf_counter()
+    try:
+        async with session.get(f'{proxy_base}/stream/{encoded}') as resp:
+            if resp.status != 200:
+                results.error(f'stream_{resp.status}')
+                return
+            first = True
+            while time.time() < stop_at:
+                chunk = await resp.content.readany()
+                if not chunk:
+                    results.error('stream_ended' if not first else 'stream_no_data')
+                    break
+                if first:
+                    results.stream_ttfb.append(time.perf_counter() - start)
+                    first = False
+                results.bytes += len(chunk)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        results.error('stream_connection')
+
+
+def summarise(values):
+    if not values:
+        return None
+    return {
+        'count': len(values),
+        'mean':  round(statistics.fmean(values) * 1000, 2),
+        'p50':   round(percentile(values, 50) * 1000, 2),
+        'p90':   round(percentile(values, 90) * 1000, 2),
+        'p99':   round(percentile(values, 99) * 1000, 2),
+        'max':   round(max(values) * 1000, 2),
+    }
+
+
+async def run(args):
+    origin_port = free_port()
+    proxy_port = free_port()
+    home_dir = tempfile.mkdtemp(prefix='tic-benchmark-')
+    stream_content = None
+    if args.scenario != 'hls':
+        stream_content = encode_stream_content(os.path.join(home_dir, 'stream.ts'), args.stream_kbps * 1000)
+    origin = FakeOrigin(origin_port, args.segment_duration, args.segment_kb * 1024, args.window, stream_content,
+                        args.origin_latency / 1000)
+    env_overrides = dict(item.split('=', 1) for item in args.env)
+    proxy = ProxyProcess(proxy_port, home_dir, env_overrides)
+    results = Results()
+    try:
+        await origin.start()
+        proxy.start()
+        await proxy.wait_until_ready()
+        proxy_base = f'http://127.0.0.1:{proxy_port}/{PROXY_PREFIX}'
+        rss_start, cpu_start = proxy.usage()
+
+        stop_at = time.time() + args.duration
+        connector = aiohttp.TCPConnector(limit=0)
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=30)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            viewers = []
+            for viewer in range(args.viewers):
+                channel = viewer % args.channels
+                if args.scenario == 'stream' or (args.scenario == 'mixed' and viewer % 2):
+                    channel_url = f'http://127.0.0.1:{origin_port}/raw/{channel}.ts'
+                    viewers.append(stream_viewer(session, proxy_base, channel_url, stop_at, results))
+                else:
+                    channel_url = f'http://127.0.0.1:{origin_port}/live/{channel}/index.m3u8'
+                    viewers.append(hls_viewer(session, proxy_base, channel_url, args.segment_duration, stop_at,
+                                              results))
+
+            # Sample proxy memory while the viewers run
+            rss_peak = rss_start
+
+            async def sample():
+                nonlocal rss_peak
+                while time.time() < stop_at:
+                    rss_peak = max(rss_peak, proxy.usage()[0])
+                    await asyncio.sleep(1)
+
+            await asyncio.gather(sample(), *viewers)
+
+        rss_end, cpu_end = proxy.usage()
+        cpu_used = cpu_end - cpu_start
+        return {
+            'config':            {
+                'scenario':         args.scenario,
+                'viewers':          args.viewers,
+                'channels':         args.channels,
+                'duration':         args.duration,
+                'segment_duration': args.segment_duration,
+                'segment_kb':       args.segment_kb,
+                'stream_kbps':      args.stream_kbps,
+                'origin_latency':   args.origin_latency,
+                'env':              env_overrides,
+            },
+            'manifest_ttfb_ms':  summarise(results.manifest_ttfb),
+            'segment_ttfb_ms':   summarise(results.segment_ttfb),
+            'stream_ttfb_ms':    summarise(results.stream_ttfb),
+            'segments_served':   results.segments,
+            'bytes_served':      results.bytes,
+            'errors':            results.errors,
+            'upstream_requests': origin.requests,
+            'proxy_memory_mb':   {
+                'start':  round(rss_start / 1048576, 1),
+                'peak':   round(rss_peak / 1048576, 1),
+                'end':    round(rss_end / 1048576, 1),
+                'growth': round((rss_end - rss_start) / 1048576, 1),
+            },
+            'proxy_cpu':         {
+                'seconds':                   round(cpu_used, 2),
+                'percent_of_one_core':       round(cpu_used / args.duration * 100, 1),
+                'ms_per_viewer_per_second': round(cpu_used / args.viewers / args.duration * 1000, 3),
+            },
+        }
+    finally:
+        proxy.stop()
+        await origin.stop()
+        shutil.rmtree(home_dir, ignore_errors=True)
+
+
+def print_report(report):
+    print(f"Scenario: {report['config']['scenario']}, {report['config']['viewers']} viewers across "
+          f"{report['config']['channels']} channels for {report['config']['duration']}s")
+    for key in ('manifest_ttfb_ms', 'segment_ttfb_ms', 'stream_ttfb_ms'):
+        if report[key]:
+            values = report[key]
+            print(f"  {key:<18} n={values['count']:<6} p50={values['p50']:<8} p90={values['p90']:<8} "
+                  f"p99={values['p99']:<8} max={values['max']}")
+    print(f"  segments served    {report['segments_served']} ({report['bytes_served'] / 1048576:.1f} MiB)")
+    print(f"  upstream requests  {report['upstream_requests']}")
+    print(f"  errors             {report['errors'] or 'none'}")
+    print(f"  proxy memory (MB)  {report['proxy_memory_mb']}")
+    print(f"  proxy CPU          {report['proxy_cpu']}")
+
+
+def check_report(report):
+    """Return the reasons a benchmark run is not valid, if any."""
+    failures = []
+    if report['errors']:
+        failures.append(f"{sum(report['errors'].values())} requests failed ({report['errors']})")
+    if not report['bytes_served']:
+        failures.append("no data was served")
+    if report['config']['scenario'] != 'stream' and not report['segments_served']:
+        failures.append("no HLS segments were served")
+    if report['config']['scenario'] != 'hls' and not report['stream_ttfb_ms']:
+        failures.append("no stream relay connection received data")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=['hls', 'stream', 'mixed'], default='hls',
+                        help="Viewers fetch HLS through the m3u8/ts routes, hold stream relay connections, or both")
+    parser.add_argument('--viewers', type=int, default=200, help="Number of simulated viewers")
+    parser.add_argument('--channels', type=int, default=10, help="Number of distinct channels to spread viewers over")
+    parser.add_argument('--duration', type=int, default=60, help="Seconds to run the viewers for")
+    parser.add_argument('--segment-duration', type=float, default=2.0, help="Origin segment duration in seconds")
+    parser.add_argument('--segment-kb', type=int, default=1024, help="Origin segment size in KiB")
+    parser.add_argument('--window', type=int, default=6, help="Number of segments in the origin manifest")
+    parser.add_argument('--stream-kbps', type=int, default=4000, help="Video bitrate of the origin raw TS streams")
+    parser.add_argument('--origin-latency', type=int, default=50, help="Added origin response latency in ms")
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help="Extra environment for the proxy process (eg. HLS_PROXY_PREFETCH_SEGMENTS=0)")
+    parser.add_argument('--output', help="Also write the report as JSON to this file")
+    args = parser.parse_args()
+
+    if args.scenario != 'hls' and not shutil.which('ffmpeg'):
+        parser.error("The stream scenarios relay through FFmpeg, but ffmpeg was not found in PATH")
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    failures = check_report(report)
+    if failures:
+        sys.exit(f"Benchmark run failed: {'; '.join(failures)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,13 @@ logger = logging.getLogger('alembic.env')
 target_metadata = Base.metadata
 
 
+def include_object(object, name, type_, reflected, compare_to):
+    # The FTS5 full text index tables are created by a migration and are not part of the models
+    if type_ == 'table' and name.startswith('playlist_streams_fts'):
+        return False
+    return True
+
+
 def run_migrations_offline():
     """Run migrations in 'offline' mode.
 
@@ -26,7 +33,8 @@ def run_migrations_offline():
     script output.
     """
     context.configure(
-        url=sqlalchemy_database_uri, target_metadata=target_metadata, literal_binds=True
+        url=sqlalchemy_database_uri, target_metadata=target_metadata, literal_binds=True,
+        include_object=include_object
     )
 
     with context.begin_transaction():
@@ -59,6 +67,7 @@ def run_migrations_online():
         context.configure(
             connection=connection,
             target_metadata=target_metadata,
+            include_object=include_object,
             process_revision_directives=process_revision_directives,
         )
 
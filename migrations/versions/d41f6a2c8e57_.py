@@ -0,0 +1,56 @@
+"""empty message
+
+Revision ID: d41f6a2c8e57
+Revises: b7d3e91c5a20
+Create Date: 2026-10-18 19:42:08.117364
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41f6a2c8e57'
+down_revision = 'b7d3e91c5a20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Full text index of playlist stream names, groups and tvg-ids, kept in sync with the table by triggers.
+    # NOTE: A batch_alter_table on playlist_streams recreates the table and drops these triggers. Recreate them after.
+    op.execute(
+        "CREATE VIRTUAL TABLE playlist_streams_fts USING fts5("
+        "name, group_title, tvg_id, "
+        "content='playlist_streams', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+    )
+    op.execute(
+        "CREATE TRIGGER playlist_streams_fts_insert AFTER INSERT ON playlist_streams BEGIN "
+        "INSERT INTO playlist_streams_fts (rowid, name, group_title, tvg_id) "
+        "VALUES (new.id, new.name, new.group_title, new.tvg_id); "
+        "END"
+    )
+    op.execute(
+        "CREATE TRIGGER playlist_streams_fts_delete AFTER DELETE ON playlist_streams BEGIN "
+        "INSERT INTO playlist_streams_fts (playlist_streams_fts, rowid, name, group_title, tvg_id) "
+        "VALUES ('delete', old.id, old.name, old.group_title, old.tvg_id); "
+        "END"
+    )
+    op.execute(
+        "CREATE TRIGGER playlist_streams_fts_update AFTER UPDATE OF name, group_title, tvg_id ON playlist_streams "
+        "BEGIN "
+        "INSERT INTO playlist_streams_fts (playlist_streams_fts, rowid, name, group_title, tvg_id) "
+        "VALUES ('delete', old.id, old.name, old.group_title, old.tvg_id); "
+        "INSERT INTO playlist_streams_fts (rowid, name, group_title, tvg_id) "
+        "VALUES (new.id, new.name, new.group_title, new.tvg_id); "
+        "END"
+    )
+    # Index the existing streams
+    op.execute("INSERT INTO playlist_streams_fts (playlist_streams_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS playlist_streams_fts_update")
+    op.execute("DROP TRIGGER IF EXISTS playlist_streams_fts_delete")
+    op.execute("DROP TRIGGER IF EXISTS playlist_streams_fts_insert")
+    op.execute("DROP TABLE IF EXISTS playlist_streams_fts")
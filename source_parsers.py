@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+Parsers for playlist and EPG sources that run in the parse worker pool (see backend.downloads.run_in_parse_pool).
+
+This is a top level module rather than part of the backend package, as importing anything from that package first
+imports the whole app (see backend/__init__.py). The fork server of the worker pool preloads this module and
+workers import nothing else of the app (see run.py), so it must only import from the standard library.
+"""
+import codecs
+import hashlib
+import io
+import json
+import pickle
+import re
+import xml.etree.ElementTree as ET
+
+# The playlist stream details that are imported from an M3U file
+PLAYLIST_STREAM_COLUMNS = ('name', 'url', 'channel_id', 'group_title', 'tvg_chno', 'tvg_id', 'tvg_logo')
+
+# Number of XMLTV programmes written to the spool file per batch
+XMLTV_SPOOL_BATCH_SIZE = 1000
+
+# Matches the encoding in an XML declaration, eg. <?xml version="1.0" encoding="ISO-8859-1"?>
+_XML_ENCODING_RE = re.compile(rb'^[^>]*encoding=["\']([A-Za-z0-9._-]+)["\']')
+
+# Matches one attribute of an #EXTINF line, eg. tvg-id="bbc1.uk" or tvg-chno=101
+_EXTINF_ATTRIBUTE_RE = re.compile(r'([A-Za-z0-9_-]+)=(?:"([^"]*)"|([^\s,"]*))')
+
+
+def parse_m3u_extinf(line):
+    """Split an #EXTINF line into the stream name and a dict of its attributes."""
+    attributes = {}
+    position = 8
+    # The name follows the first comma that is not inside an attribute value
+    comma = line.find(',', position)
+    while True:
+        match = _EXTINF_ATTRIBUTE_RE.search(line, position)
+        if match is None or (comma != -1 and match.start() > comma):
+            break
+        attributes[match.group(1)] = match.group(2) if match.group(2) is not None else match.group(3)
+        position = match.end()
+        if comma != -1 and comma < position:
+            comma = line.find(',', position)
+    name = line[comma + 1:].strip() if comma != -1 else ''
+    return name, attributes
+
+
+def m3u_stream_details(name, url, attributes):
+    tvg_channel_number = attributes.get('tvg-chno')
+    try:
+        tvg_channel_number = int(tvg_channel_number) if tvg_channel_number else None
+    except ValueError:
+        tvg_channel_number = None
+    return {
+        'name':        name,
+        'url':         url,
+        'channel_id':  attributes.get('channel-id'),
+        'group_title': attributes.get('group-title'),
+        'tvg_chno':    tvg_channel_number,
+        'tvg_id':      attributes.get('tvg-id'),
+        'tvg_logo':    attributes.get('tvg-logo'),
+    }
+
+
+def _hash_values(*values):
+    data = '\x1f'.join('\x00' if value is None else str(value) for value in values)
+    return hashlib.blake2b(data.encode('utf-8', errors='replace'), digest_size=16).hexdigest()
+
+
+def playlist_stream_staging_row(stream):
+    """
+    Return a parsed stream as a row for the import staging table: its identity, a hash of its details and then
+    the details in the order of PLAYLIST_STREAM_COLUMNS.
+    A stream is identified by a hash of its tvg-id and name, or of its URL when it has neither.
+    """
+    if stream['tvg_id'] or stream['name']:
+        identity = _hash_values(stream['tvg_id'], stream['name'])
+    else:
+        identity = _hash_values(stream['url'])
+    values = tuple(stream[column] for column in PLAYLIST_STREAM_COLUMNS)
+    return (identity, _hash_values(*values)) + values
+
+
+def parse_m3u_lines(text, extinf=None):
+    """
+    Parse a block of complete lines from an M3U playlist into staging table rows.
+    Takes the #EXTINF entry left pending by the previous block, and returns the rows together with the entry left
+    pending at the end of this one.
+    """
+    streams = []
+    for line in text.split('\n'):
+        line = line.strip().lstrip('\ufeff')
+        if not line:
+            continue
+        if line.startswith('#'):
+            if line[:8].upper() == '#EXTINF:':
+                extinf = parse_m3u_extinf(line)
+            continue
+        if extinf is None:
+            # A URL without an #EXTINF line has no name to import it with
+            continue
+        name, attributes = extinf
+        extinf = None
+        streams.append(playlist_stream_staging_row(m3u_stream_details(name, line, attributes)))
+    return streams, extinf
+
+
+def open_xml_text(xml_file):
+    """
+    Open an XML file as text, decoded with the encoding in its XML declaration (UTF-8 if it has none).
+    Bytes that are not valid in that encoding are replaced rather than failing the whole parse.
+    """
+    f = open(xml_file, 'rb')
+    match = _XML_ENCODING_RE.match(f.read(256))
+    f.seek(0)
+    encoding = match.group(1).decode('ascii') if match else 'utf-8'
+    try:
+        codec_name = codecs.lookup(encoding).name
+    except LookupError:
+        codec_name = 'utf-8'
+    if codec_name == 'utf-8':
+        # Also skip a byte order mark
+        codec_name = 'utf-8-sig'
+    return io.TextIOWrapper(f, encoding=codec_name, errors='replace')
+
+
+def parse_xmltv_file(xmltv_file, spool_file):
+    """
+    Parse the channels and programmes from an XMLTV file.
+    The file is parsed incrementally and each element is released once it has been read. Bytes that are invalid in
+    the file's encoding are replaced (see open_xml_text()). Programmes are written to the spool file in batches (read
+    them back with read_xmltv_spool()), so neither the worker nor the app holds every programme of the EPG in memory
+    at once.
+    Returns the list of channels and the number of programmes parsed.
+    """
+    channels = []
+    programmes = []
+    programme_count = 0
+    with open_xml_text(xmltv_file) as xml_text, open(spool_file, 'wb') as spool:
+        for _, element in ET.iterparse(xml_text, events=('end',)):
+            if element.tag == 'channel':
+                icon_elem = element.find('icon')
+                channels.append({
+                    'channel_id': element.get('id'),
+                    'name':       element.findtext('display-name'),
+                    'icon_url':   icon_elem.attrib.get('src', '') if icon_elem is not None else '',
+                })
+                element.clear()
+            elif element.tag == 'programme':
+                icon = element.find("icon")
+                programmes.append({
+                    'channel_id':      element.attrib.get('channel', None),
+                    'title':           element.findtext("title", default=None),
+                    'sub_title':       element.findtext("sub-title", default=None),
+                    'desc':            element.findtext("desc", default=None),
+                    'series_desc':     element.findtext("series-desc", default=None),
+                    'icon_url':        icon.attrib.get('src', None) if icon is not None else None,
+                    'country':         element.findtext("country", default=None),
+                    'start':           element.attrib.get('start', None),
+                    'stop':            element.attrib.get('stop', None),
+                    'start_timestamp': element.attrib.get('start_timestamp', None),
+                    'stop_timestamp':  element.attrib.get('stop_timestamp', None),
+                    'categories':      json.dumps([category.text for category in element.findall("category")]),
+                    # TODO: Import rating
+                    # TODO: Import star rating
+                })
+                element.clear()
+                if len(programmes) >= XMLTV_SPOOL_BATCH_SIZE:
+                    pickle.dump(programmes, spool, protocol=pickle.HIGHEST_PROTOCOL)
+                    programme_count += len(programmes)
+                    programmes = []
+        if programmes:
+            pickle.dump(programmes, spool, protocol=pickle.HIGHEST_PROTOCOL)
+            programme_count += len(programmes)
+    return channels, programme_count
+
+
+def read_xmltv_spool(spool_file):
+    """Yield the batches of programmes written to a spool file by parse_xmltv_file()."""
+    with open(spool_file, 'rb') as spool:
+        while True:
+            try:
+                yield pickle.load(spool)
+            except EOFError:
+                return
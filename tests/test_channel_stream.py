@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+import unittest
+
+from backend.api.routes_hls_proxy import ChannelStream
+
+
+class ChannelStreamSourceReadersTestCase(unittest.TestCase):
+
+    def test_leaving_a_source_disconnects_its_stream_readers(self):
+        stream = ChannelStream(1, ['http://origin/a.ts', 'http://origin/b.ts'])
+        mux_reader = stream.add_reader('mux')
+        mux_reader.source_url = 'http://origin/a.ts'
+        channel_reader = stream.add_reader('channel')
+        stream.disconnect_source_readers('http://origin/a.ts')
+        # Readers that asked for the source URL must not be handed the next source's stream
+        self.assertTrue(mux_reader.disconnected)
+        self.assertEqual(stream.buffer.read(mux_reader), b'')
+        # Readers of the channel itself follow the failover
+        self.assertFalse(channel_reader.disconnected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+import unittest
+
+from backend.api.routes_hls_proxy import StreamRingBuffer, TS_PACKET_SIZE, TS_SYNC_BYTE
+
+PMT_PID = 0x1000
+VIDEO_PID = 0x100
+
+
+def ts_packet(pid, payload, payload_unit_start=True, random_access=False):
+    header = bytes([
+        TS_SYNC_BYTE,
+        (0x40 if payload_unit_start else 0) | (pid >> 8),
+        pid & 0xff,
+    ])
+    if random_access:
+        # Adaptation field followed by the payload, with the random access indicator set
+        adaptation_field = bytes([1, 0x40])
+        packet = header + bytes([0x30]) + adaptation_field + payload
+    else:
+        packet = header + bytes([0x10]) + payload
+    return packet + b'\xff' * (TS_PACKET_SIZE - len(packet))
+
+
+def pat_packet():
+    # Pointer field, then a PAT section listing program 1 on the PMT PID
+    section = bytes([0x00, 0xb0, 13, 0x00, 0x01, 0xc1, 0x00, 0x00,
+                     0x00, 0x01, 0xe0 | (PMT_PID >> 8), PMT_PID & 0xff]) + b'\x00' * 4
+    return ts_packet(0, b'\x00' + section)
+
+
+def pmt_packet():
+    # Pointer field, then a PMT section with a single H.264 video stream
+    section = bytes([0x02, 0xb0, 18, 0x00, 0x01, 0xc1, 0x00, 0x00,
+                     0xe0 | (VIDEO_PID >> 8), VIDEO_PID & 0xff, 0xf0, 0x00,
+                     0x1b, 0xe0 | (VIDEO_PID >> 8), VIDEO_PID & 0xff, 0xf0, 0x00]) + b'\x00' * 4
+    return ts_packet(PMT_PID, b'\x00' + section)
+
+
+def keyframe_packet():
+    return ts_packet(VIDEO_PID, b'\x00\x00\x01\xe0', random_access=True)
+
+
+class StreamRingBufferKeyframeJoinTestCase(unittest.TestCase):
+
+    def test_keyframe_before_pmt_is_not_a_join_point(self):
+        buffer = StreamRingBuffer(max_bytes=1024 * 1024)
+        buffer.append(pat_packet())
+        buffer.append(keyframe_packet())
+        buffer.append(pmt_packet())
+        # The PMT listed by the PAT had not arrived at the keyframe, so new readers start at the live edge
+        self.assertIsNone(buffer.last_keyframe)
+        reader = buffer.create_reader('reader')
+        self.assertIsNone(reader.pending)
+        self.assertEqual(buffer.read(reader), b'')
+
+    def test_reader_joins_at_keyframe_after_tables(self):
+        buffer = StreamRingBuffer(max_bytes=1024 * 1024)
+        buffer.append(pat_packet())
+        buffer.append(keyframe_packet())
+        buffer.append(pmt_packet())
+        keyframe = keyframe_packet()
+        buffer.append(keyframe)
+        reader = buffer.create_reader('reader')
+        self.assertEqual(buffer.read(reader), pat_packet() + pmt_packet() + keyframe)
+
+
+if __name__ == '__main__':
+    unittest.main()